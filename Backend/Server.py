@@ -1,80 +1,823 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Cookie, Response, Header, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Cookie, Response, Header, UploadFile, File, Request, Query
+from fastapi.responses import JSONResponse, ORJSONResponse, FileResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, DuplicateKeyError
+from pymongo import monitoring
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
 import uuid
+import re
+import hashlib
+from urllib.parse import quote
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
+from cachetools import TTLCache, LRUCache
+from collections import deque
 import jwt
 import base64
 import json
-import requests
+import orjson
+import zlib
+import csv
+import io
+import httpx
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics, exposed in Prometheus text format on /metrics
+MONGO_SLOW_MS = float(os.environ.get('MONGO_SLOW_MS', '100'))
+
+HTTP_REQUEST_DURATION = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route"])
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+MONGO_COMMAND_DURATION = Histogram("mongo_command_duration_seconds", "MongoDB command latency", ["collection", "command"])
+MONGO_COMMAND_FAILURES = Counter("mongo_command_failures_total", "Failed MongoDB commands", ["collection", "command"])
+WS_ACTIVE_CONNECTIONS = Gauge("ws_active_connections", "Open WebSocket connections on this worker")
+WS_SEND_DURATION = Histogram("ws_send_duration_seconds", "WebSocket send latency")
+WS_SEND_FAILURES = Counter("ws_send_failures_total", "WebSocket sends that failed or timed out")
+WS_FRAMES = Counter("ws_frames_total", "WebSocket frames by direction and type", ["direction", "type"])
+RATE_LIMITED = Counter("rate_limited_total", "Requests and frames rejected by the rate limiter", ["action"])
+DIRECTORY_LOOKUPS = Counter("directory_cache_lookups_total", "Server/channel directory cache lookups", ["cache", "result"])
+WS_FRAME_TYPES = {"offer", "answer", "ice-candidate", "typing", "message", "dm", "resume", "set_status", "read"}
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self.pending: Dict[tuple, tuple] = {}  # (connection, request_id): (collection, command)
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        self.pending[(event.connection_id, event.request_id)] = (collection, event.command_name)
+
+    def succeeded(self, event):
+        labels = self.pending.pop((event.connection_id, event.request_id), ("", event.command_name))
+        MONGO_COMMAND_DURATION.labels(*labels).observe(event.duration_micros / 1e6)
+        if event.duration_micros / 1000 >= MONGO_SLOW_MS:
+            logger.warning(f"Slow MongoDB {labels[1]} on {labels[0] or 'admin'}: {event.duration_micros / 1000:.1f} ms")
+
+    def failed(self, event):
+        labels = self.pending.pop((event.connection_id, event.request_id), ("", event.command_name))
+        MONGO_COMMAND_DURATION.labels(*labels).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(*labels).inc()
+
+# Records latency and status per route template (not per raw path, to keep label cardinality bounded)
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_DURATION.labels(scope["method"], route_path).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(scope["method"], route_path, str(status[0])).inc()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[MongoCommandMetrics()])
 db = client[os.environ['DB_NAME']]
 
-# Password hashing
+# Password hashing, run on a bounded thread pool so bcrypt never blocks the event loop.
+# The default leaves a core for the loop: hash threads beyond the spare cores slow every
+# other request during a login burst
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, max(1, (os.cpu_count() or 2) - 1)))))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+# Indexes, (collection, keys, options). Created idempotently on startup.
+# user_number is not unique at the database level: Google users all share "00000000".
+INDEXES = [
+    ("users", [("id", ASCENDING)], {"unique": True}),
+    ("users", [("email", ASCENDING)], {"unique": True}),
+    ("users", [("user_number", ASCENDING)], {}),
+    ("users", [("username_lower", ASCENDING)], {}),
+    ("user_sessions", [("session_token", ASCENDING)], {"unique": True}),
+    ("user_sessions", [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    ("servers", [("id", ASCENDING)], {"unique": True}),
+    ("server_members", [("user_id", ASCENDING)], {}),
+    ("server_members", [("server_id", ASCENDING), ("user_id", ASCENDING)], {"unique": True}),
+    ("channels", [("id", ASCENDING)], {"unique": True}),
+    ("channels", [("server_id", ASCENDING)], {}),
+    ("messages", [("id", ASCENDING)], {"unique": True}),
+    ("messages", [("channel_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], {}),
+    ("messages", [("dm_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], {}),
+    ("messages", [("timestamp", DESCENDING)], {}),
+    ("messages", [("content", TEXT)], {"default_language": "none"}),
+    ("direct_messages", [("id", ASCENDING)], {"unique": True}),
+    ("direct_messages", [("participants", ASCENDING)], {}),
+    ("activity_logs", [("timestamp", DESCENDING)], {}),
+    ("attachments", [("id", ASCENDING)], {"unique": True}),
+    ("read_states", [("user_id", ASCENDING), ("stream_id", ASCENDING)], {"unique": True}),
+    ("read_states", [("stream_id", ASCENDING)], {}),
+    ("message_segments", [("stream_id", ASCENDING), ("last_ts", DESCENDING)], {}),
+    ("message_segments", [("stream_id", ASCENDING), ("first_ts", ASCENDING)], {}),
+    ("message_segments", [("user_ids", ASCENDING)], {}),
+    ("message_segments", [("last_ts", DESCENDING)], {}),
+    ("server_stats", [("messages", DESCENDING)], {}),
+    ("messages", [("user_id", ASCENDING)], {}),
+    ("user_sessions", [("user_id", ASCENDING)], {}),
+    ("servers", [("owner_id", ASCENDING)], {}),
+    ("deletion_jobs", [("id", ASCENDING)], {"unique": True}),
+    ("deletion_jobs", [("status", ASCENDING), ("created_at", ASCENDING)], {}),
+    ("deletion_jobs", [("created_at", DESCENDING)], {}),
+]
+
+# Query shapes used by the endpoints, (collection, filter, sort). check_indexes.py
+# explains each of them and fails on a collection scan.
+QUERY_SHAPES = [
+    ("users", {"id": "x"}, None),
+    ("users", {"id": {"$in": ["x", "y"]}}, None),
+    ("users", {"email": "x"}, None),
+    ("users", {"user_number": "x"}, None),
+    ("users", {"username_lower": {"$regex": "^x"}}, None),
+    ("users", {"user_number": {"$regex": "^1"}}, None),
+    ("user_sessions", {"session_token": "x"}, None),
+    ("server_members", {"user_id": "x"}, None),
+    ("servers", {"id": {"$in": ["x", "y"]}}, None),
+    ("channels", {"server_id": "x"}, None),
+    ("channels", {"server_id": {"$in": ["x", "y"]}}, None),
+    ("channels", {"id": {"$in": ["x", "y"]}}, None),
+    ("messages", {"channel_id": "x"}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("messages", {"channel_id": "x", "$or": [{"timestamp": {"$lt": "t"}}, {"timestamp": "t", "id": {"$lt": "x"}}]}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("messages", {"dm_id": "x"}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("messages", {"dm_id": "x", "$or": [{"timestamp": {"$gt": "t"}}, {"timestamp": "t", "id": {"$gt": "x"}}]}, [("timestamp", ASCENDING), ("id", ASCENDING)]),
+    ("messages", {}, [("timestamp", DESCENDING)]),
+    ("messages", {"id": "x"}, None),
+    ("messages", {"$text": {"$search": "x"}, "$or": [{"channel_id": {"$in": ["x"]}}, {"dm_id": {"$in": ["y"]}}]}, None),
+    ("direct_messages", {"participants": "x"}, None),
+    ("direct_messages", {"participants": {"$all": ["x", "y"]}}, None),
+    ("direct_messages", {"id": "x"}, None),
+    ("activity_logs", {}, [("timestamp", DESCENDING)]),
+    # Membership, mentions and read markers
+    ("server_members", {"server_id": "x", "user_id": {"$in": ["x", "y"]}}, None),
+    ("users", {"username_lower": {"$in": ["x", "y"]}}, None),
+    ("direct_messages", {"id": "x", "participants": "y"}, None),
+    ("read_states", {"user_id": "x", "stream_id": "y"}, None),
+    ("read_states", {"user_id": "x"}, None),
+    ("read_states", {"user_id": {"$in": ["x", "y"]}, "stream_id": "z"}, None),
+    ("read_states", {"stream_id": {"$in": ["x", "y"]}}, None),
+    # Admin stats
+    ("messages", {"timestamp": {"$gte": "t"}}, None),
+    ("server_stats", {}, [("messages", DESCENDING)]),
+    # Deletion jobs and their steps
+    ("deletion_jobs", {"status": {"$in": ["pending", "running"]}, "$or": [{"locked_until": None}, {"locked_until": {"$lt": "t"}}]}, [("created_at", ASCENDING)]),
+    ("deletion_jobs", {"id": "x"}, None),
+    ("deletion_jobs", {}, [("created_at", DESCENDING)]),
+    ("messages", {"user_id": "x"}, None),
+    ("messages", {"channel_id": {"$in": ["x", "y"]}}, None),
+    ("messages", {"dm_id": {"$in": ["x", "y"]}}, None),
+    ("user_sessions", {"user_id": "x"}, None),
+    ("servers", {"owner_id": "x"}, None),
+    ("attachments", {"id": "x"}, None),
+    # Message archive
+    ("messages", {"channel_id": "x", "timestamp": {"$lt": "t"}}, [("timestamp", ASCENDING), ("id", ASCENDING)]),
+    ("messages", {"dm_id": "x", "timestamp": {"$lt": "t"}}, [("timestamp", ASCENDING), ("id", ASCENDING)]),
+    ("message_segments", {"stream_id": "x", "first_ts": {"$lte": "t"}}, [("last_ts", DESCENDING)]),
+    ("message_segments", {"stream_id": "x", "last_ts": {"$gte": "t"}}, [("first_ts", ASCENDING)]),
+    ("message_segments", {"stream_id": {"$in": ["x", "y"]}}, None),
+    ("message_segments", {"user_ids": "x"}, None),
+    ("message_segments", {"last_ts": {"$gte": "t"}}, None),
+]
+
+# External OAuth session exchange
+SESSION_DATA_URL = os.environ.get('SESSION_DATA_URL', 'https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data')
+SESSION_DATA_TIMEOUT = float(os.environ.get('SESSION_DATA_TIMEOUT', '10'))
+SESSION_DATA_RETRIES = int(os.environ.get('SESSION_DATA_RETRIES', '2'))
+SESSION_DATA_CACHE_TTL = float(os.environ.get('SESSION_DATA_CACHE_TTL', '60'))
+
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(SESSION_DATA_TIMEOUT, connect=5.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+)
+session_data_cache: TTLCache = TTLCache(maxsize=10000, ttl=SESSION_DATA_CACHE_TTL)
+
+# Authenticated principal cache
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '10000'))
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '60'))
+
+# Server/channel directory cache: entries per map and a safety TTL, changes are invalidated explicitly
+DIRECTORY_CACHE_SIZE = int(os.environ.get('DIRECTORY_CACHE_SIZE', '50000'))
+DIRECTORY_CACHE_TTL = float(os.environ.get('DIRECTORY_CACHE_TTL', '300'))
+
+# Activity log pipeline
+ACTIVITY_QUEUE_SIZE = int(os.environ.get('ACTIVITY_QUEUE_SIZE', '10000'))
+ACTIVITY_BATCH_SIZE = int(os.environ.get('ACTIVITY_BATCH_SIZE', '500'))
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', '1'))
+ACTIVITY_BACKPRESSURE_TIMEOUT = float(os.environ.get('ACTIVITY_BACKPRESSURE_TIMEOUT', '0.5'))
+
+# Admin stats counters: message counts are buffered and written every flush interval
+STATS_RECONCILE_INTERVAL = float(os.environ.get('STATS_RECONCILE_INTERVAL', '3600'))
+STATS_FLUSH_INTERVAL = float(os.environ.get('STATS_FLUSH_INTERVAL', '1'))
+STATS_DAYS = 7
+STATS_TOP_SERVERS = 10
+
+# Admin exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+
+# Background cascade deletion
+DELETE_BATCH_SIZE = int(os.environ.get('DELETE_BATCH_SIZE', '1000'))
+DELETE_BATCH_DELAY = float(os.environ.get('DELETE_BATCH_DELAY', '0.05'))
+DELETE_POLL_INTERVAL = float(os.environ.get('DELETE_POLL_INTERVAL', '2'))
+DELETE_LEASE_SECONDS = float(os.environ.get('DELETE_LEASE_SECONDS', '60'))
+
+# Message archive: messages older than ARCHIVE_AFTER_DAYS move into compressed per-channel/DM
+# segments of ARCHIVE_SEGMENT_SIZE messages (0 disables archiving)
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', '0'))
+ARCHIVE_SEGMENT_SIZE = int(os.environ.get('ARCHIVE_SEGMENT_SIZE', '1000'))
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))
+ARCHIVE_BATCH_DELAY = float(os.environ.get('ARCHIVE_BATCH_DELAY', '0.05'))
+ARCHIVE_PURGE_BATCH = int(os.environ.get('ARCHIVE_PURGE_BATCH', '20'))
+
+# Attachments, stored once per SHA-256 under BLOB_DIR/<first 2 hex chars>/<hash>
+BLOB_DIR = Path(os.environ.get('BLOB_DIR', str(ROOT_DIR / 'blobs')))
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(25 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Uploads are buffered up to this size per disk write, each write runs off the event loop
+UPLOAD_WRITE_SIZE = 1024 * 1024
+# Only these types are served inline from the API origin; anything else (HTML, SVG, scripts...)
+# is sent as an application/octet-stream download
+INLINE_CONTENT_TYPES = {
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/avif",
+    "video/mp4", "video/webm", "video/ogg", "audio/mpeg", "audio/ogg", "audio/wav", "audio/webm",
+    "application/pdf", "text/plain",
+}
+
+# Search
+SEARCH_PAGE_MAX = int(os.environ.get('SEARCH_PAGE_MAX', '50'))
+
+# Datetime fields that older versions stored as ISO strings, converted once to BSON dates
+DATETIME_FIELDS = [
+    ("users", "created_at"),
+    ("servers", "created_at"),
+    ("channels", "created_at"),
+    ("server_members", "joined_at"),
+    ("messages", "timestamp"),
+    ("direct_messages", "created_at"),
+    ("user_sessions", "expires_at"),
+    ("user_sessions", "created_at"),
+    ("activity_logs", "timestamp"),
+    ("attachments", "created_at"),
+]
+
+# Message history pagination
+MESSAGE_PAGE_DEFAULT = int(os.environ.get('MESSAGE_PAGE_DEFAULT', '50'))
+MESSAGE_PAGE_MAX = int(os.environ.get('MESSAGE_PAGE_MAX', '200'))
+
+# Read markers: at most this many distinct @username mentions are counted per message
+MAX_MENTIONS = int(os.environ.get('MAX_MENTIONS', '20'))
+MENTION_RE = re.compile(r"@([\w.-]+)")
 
 # JWT settings
 SECRET_KEY = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 ALGORITHM = "HS256"
 
 # WebSocket connection manager
-class ConnectionManager:
+WS_SEND_TIMEOUT = float(os.environ.get('WS_SEND_TIMEOUT', '5'))
+# Pub/sub broker connecting the workers, e.g. redis://localhost:6379/0. In-memory when unset.
+WS_BROKER_URL = os.environ.get('WS_BROKER_URL', '')
+WS_BROKER_CHANNEL = os.environ.get('WS_BROKER_CHANNEL', 'miiwiichat:ws')
+# Received broker events are handled by this many dispatchers, each with a bounded queue;
+# events of one channel/DM/user always go to the same dispatcher so they stay in order
+WS_BROKER_DISPATCHERS = int(os.environ.get('WS_BROKER_DISPATCHERS', '16'))
+WS_BROKER_QUEUE_SIZE = int(os.environ.get('WS_BROKER_QUEUE_SIZE', '1000'))
+# Longest wait between attempts to resubscribe after losing the broker connection
+WS_BROKER_RECONNECT_MAX = float(os.environ.get('WS_BROKER_RECONNECT_MAX', '30'))
+# Presence: how long a dropped user stays online before going offline, and how often
+# coalesced presence_batch frames are sent
+PRESENCE_DEBOUNCE = float(os.environ.get('PRESENCE_DEBOUNCE', '5'))
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '1'))
+PRESENCE_STATUSES = {"online", "away", "dnd"}
+# Replay buffer for reconnecting clients: events kept per channel/DM and how many streams are kept
+REPLAY_BUFFER_SIZE = int(os.environ.get('REPLAY_BUFFER_SIZE', '200'))
+REPLAY_MAX_STREAMS = int(os.environ.get('REPLAY_MAX_STREAMS', '10000'))
+# How long acks for WebSocket sends are remembered so client retries with the same nonce are not re-posted
+WS_NONCE_TTL = float(os.environ.get('WS_NONCE_TTL', '300'))
+# Typing: one typing event per (user, channel) is accepted per throttle window, and accepted
+# events are sent as one typing_batch frame per channel every flush interval
+TYPING_THROTTLE = float(os.environ.get('TYPING_THROTTLE', '3'))
+TYPING_FLUSH_INTERVAL = float(os.environ.get('TYPING_FLUSH_INTERVAL', '1'))
+
+# Per-user token buckets, "action=rate/burst" with rate in tokens per second
+RATE_LIMITS = {
+    action: (float(rate), float(burst))
+    for action, rate, burst in (
+        re.fullmatch(r"(\w+)=([\d.]+)/([\d.]+)", item.strip()).groups()
+        for item in os.environ.get('RATE_LIMITS', 'message=5/20,create_server=0.05/5,create_channel=0.2/10,search=2/20,read=2/10').split(',')
+    )
+}
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+
+# Brokers carry WebSocket events between workers. Every worker publishes an event
+# once and every worker (including the publisher) delivers it to its own sockets.
+class InMemoryBroker:
     def __init__(self):
+        self.handler = None
+
+    async def start(self, handler):
+        self.handler = handler
+
+    async def publish(self, event: dict):
+        if self.handler is not None:
+            await self.handler(event)
+
+    async def stop(self):
+        pass
+
+class RedisBroker:
+    def __init__(self, url: str, channel: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("WS_BROKER_URL points at Redis but the redis package is not installed")
+        self.redis = redis.from_url(url)
+        self.channel = channel
+        self.pubsub = None
+        self.queues: List[asyncio.Queue] = []
+        self.tasks: List[asyncio.Task] = []
+
+    async def start(self, handler):
+        self.handler = handler
+        self.queues = [asyncio.Queue(maxsize=WS_BROKER_QUEUE_SIZE) for _ in range(WS_BROKER_DISPATCHERS)]
+        self.tasks = [asyncio.create_task(self._dispatch(queue)) for queue in self.queues]
+        await self._subscribe()
+        self.tasks.append(asyncio.create_task(self._listen()))
+
+    async def _subscribe(self):
+        self.pubsub = self.redis.pubsub()
+        await self.pubsub.subscribe(self.channel)
+
+    async def _unsubscribe(self):
+        if self.pubsub is not None:
+            try:
+                await self.pubsub.aclose()
+            except Exception:
+                pass
+            self.pubsub = None
+
+    async def _listen(self):
+        # Only reads and routes events so a slow fan-out never holds up the subscription;
+        # a lost connection is resubscribed with exponential backoff
+        attempt = 0
+        while True:
+            try:
+                if self.pubsub is None:
+                    await self._subscribe()
+                    logger.info("Resubscribed to the WebSocket broker")
+                async for item in self.pubsub.listen():
+                    attempt = 0
+                    if item["type"] == "message":
+                        await self._route(item["data"])
+                raise ConnectionError("subscription closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = min(WS_BROKER_RECONNECT_MAX, 0.5 * 2 ** attempt)
+                attempt += 1
+                logger.error(f"WebSocket broker connection lost, resubscribing in {delay:.1f}s: {e}")
+                await self._unsubscribe()
+                await asyncio.sleep(delay)
+
+    async def _route(self, data):
+        try:
+            event = json.loads(data)
+        except ValueError as e:
+            logger.error(f"Dropped malformed broker event: {e}")
+            return
+        key = event.get("channel_id") or event.get("dm_id") or event.get("user_id") or event.get("server_id") or ""
+        # Waits when the dispatcher is backed up, which leaves further events buffered in Redis
+        await self.queues[hash(key) % len(self.queues)].put(event)
+
+    async def _dispatch(self, queue: asyncio.Queue):
+        while True:
+            event = await queue.get()
+            try:
+                await self.handler(event)
+            except Exception as e:
+                logger.error(f"Failed to handle broker event: {e}")
+
+    async def publish(self, event: dict):
+        await self.redis.publish(self.channel, json.dumps(event, default=str))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        await self._unsubscribe()
+        await self.redis.aclose()
+
+def create_broker(url: str):
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBroker(url, WS_BROKER_CHANNEL)
+    return InMemoryBroker()
+
+# Presence updates go only to connected users sharing a server or DM with the subject.
+# Disconnects are debounced, updates are coalesced per recipient into presence_batch
+# frames and status changes are persisted to users.status in bulk.
+class PresenceService:
+    def __init__(self, manager: "ConnectionManager"):
+        self.manager = manager
+        self.pending_offline: Dict[str, asyncio.Task] = {}
+        self.pending_frames: Dict[str, Dict[str, str]] = {}  # recipient: {user_id: status}
+        self.pending_writes: Dict[str, str] = {}  # user_id: status
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for user_id in list(self.pending_offline) + list(self.manager.active_connections):
+            self.pending_writes[user_id] = "offline"
+        for task in self.pending_offline.values():
+            task.cancel()
+        self.pending_offline.clear()
+        await self.flush()
+
+    async def connected(self, user_id: str):
+        task = self.pending_offline.pop(user_id, None)
+        if task is not None:
+            # Reconnected within the debounce window, nobody saw the drop
+            task.cancel()
+            return
+        status = self.manager.user_status.get(user_id)
+        await self.publish(user_id, status if status in ("away", "dnd") else "online")
+
+    def disconnected(self, user_id: str, server_ids: Set[str], peer_ids: Set[str]):
+        self.pending_offline[user_id] = asyncio.create_task(self._offline_after_debounce(user_id, server_ids, peer_ids))
+
+    async def _offline_after_debounce(self, user_id: str, server_ids: Set[str], peer_ids: Set[str]):
+        await asyncio.sleep(PRESENCE_DEBOUNCE)
+        self.pending_offline.pop(user_id, None)
+        await self.publish(user_id, "offline", server_ids, peer_ids)
+
+    async def publish(self, user_id: str, status: str, server_ids: Optional[Set[str]] = None, peer_ids: Optional[Set[str]] = None):
+        if server_ids is None:
+            server_ids = self.manager.user_servers.get(user_id, set())
+        if peer_ids is None:
+            peer_ids = self.manager.user_peers.get(user_id, set())
+        self.pending_writes[user_id] = status
+        await self.manager.broker.publish({
+            "kind": "status", "user_id": user_id, "status": status,
+            "server_ids": list(server_ids), "peer_ids": list(peer_ids)
+        })
+
+    def handle_event(self, event: dict):
+        user_id, status = event["user_id"], event["status"]
+        if status == "offline":
+            self.manager.user_status.pop(user_id, None)
+        else:
+            self.manager.user_status[user_id] = status
+            # The user may have reconnected to another worker
+            task = self.pending_offline.pop(user_id, None)
+            if task is not None:
+                task.cancel()
+        for recipient in self.manager.interested_users(event["server_ids"], event["peer_ids"]):
+            if recipient != user_id:
+                self.pending_frames.setdefault(recipient, {})[user_id] = status
+
+    async def flush(self):
+        frames, self.pending_frames = self.pending_frames, {}
+        writes, self.pending_writes = self.pending_writes, {}
+        if writes:
+            try:
+                await db.users.bulk_write([UpdateOne({"id": uid}, {"$set": {"status": st}}) for uid, st in writes.items()], ordered=False)
+            except Exception as e:
+                logger.error(f"Failed to persist {len(writes)} presence updates: {e}")
+        if frames:
+            await asyncio.gather(*(
+                self.manager.send_local({"type": "presence_batch", "updates": [{"user_id": uid, "status": st} for uid, st in updates.items()]}, recipient)
+                for recipient, updates in frames.items()
+            ))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Presence flush failed: {e}")
+
+# Throttles typing events per (user, channel) and coalesces them into one typing_batch
+# frame per channel per flush instead of a broadcast for every keystroke burst
+class TypingService:
+    def __init__(self, manager: "ConnectionManager"):
+        self.manager = manager
+        self.recent: TTLCache = TTLCache(maxsize=100000, ttl=TYPING_THROTTLE)  # (user_id, channel_id): True
+        self.pending: Dict[str, Set[str]] = {}  # channel_id: user_ids
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.pending.clear()
+
+    def typing(self, user_id: str, channel_id: str):
+        key = (user_id, channel_id)
+        if key in self.recent:
+            return
+        self.recent[key] = True
+        self.pending.setdefault(channel_id, set()).add(user_id)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        for channel_id, user_ids in pending.items():
+            await self.manager.broadcast_to_channel({"type": "typing_batch", "channel_id": channel_id, "user_ids": list(user_ids)}, channel_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TYPING_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Typing flush failed: {e}")
+
+class ConnectionManager:
+    def __init__(self, broker):
+        self.broker = broker
+        self.presence = PresenceService(self)
+        self.typing = TypingService(self)
         self.active_connections: Dict[str, WebSocket] = {}
-        self.user_status: Dict[str, str] = {}  # user_id: online/offline
+        self.user_status: Dict[str, str] = {}  # user_id: online/away/dnd, connected users only
+        self.user_peers: Dict[str, Set[str]] = {}  # user_id: DM partners
+        self.replay: LRUCache = LRUCache(maxsize=REPLAY_MAX_STREAMS)  # channel_id/dm_id: deque of (seq, message)
+        # Subscription index, only covers connected users
+        self.channel_subscribers: Dict[str, Set[str]] = {}  # channel_id: user_ids
+        self.server_subscribers: Dict[str, Set[str]] = {}  # server_id: user_ids
+        self.server_channels: Dict[str, Set[str]] = {}  # server_id: channel_ids
+        self.user_servers: Dict[str, Set[str]] = {}  # user_id: server_ids
 
     async def connect(self, websocket: WebSocket, user_id: str):
         await websocket.accept()
         self.active_connections[user_id] = websocket
-        self.user_status[user_id] = "online"
-        await self.broadcast_status_update(user_id, "online")
+        WS_ACTIVE_CONNECTIONS.set(len(self.active_connections))
+        await self.load_subscriptions(user_id)
+        await self.presence.connected(user_id)
+
+    async def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None):
+        # Ignore a stale socket that has already been replaced by a reconnect
+        if user_id not in self.active_connections or (websocket is not None and self.active_connections[user_id] is not websocket):
+            return
+        self._drop(user_id)
+
+    def _drop(self, user_id: str):
+        del self.active_connections[user_id]
+        WS_ACTIVE_CONNECTIONS.set(len(self.active_connections))
+        server_ids = set(self.user_servers.get(user_id, ()))
+        peer_ids = self.user_peers.pop(user_id, set())
+        self.unsubscribe_user(user_id)
+        self.presence.disconnected(user_id, server_ids, peer_ids)
+
+    async def start(self):
+        await self.broker.start(self.handle_event)
+        self.presence.start()
+        self.typing.start()
+
+    async def stop(self):
+        await self.typing.stop()
+        await self.presence.stop()
+        await self.broker.stop()
+
+    def interested_users(self, server_ids, peer_ids) -> Set[str]:
+        user_ids: Set[str] = set()
+        for server_id in server_ids:
+            user_ids.update(self.server_subscribers.get(server_id, ()))
+        user_ids.update(p for p in peer_ids if p in self.active_connections)
+        return user_ids
+
+    async def handle_event(self, event: dict):
+        # Deliver a broker event to the sockets held by this worker
+        kind = event["kind"]
+        if kind == "channel":
+            if "seq" in event:
+                self.record(event["channel_id"], event["seq"], event["message"])
+            await self._fan_out(event["message"], list(self.channel_subscribers.get(event["channel_id"], ())))
+        elif kind == "dm":
+            self.record(event["dm_id"], event["seq"], event["message"])
+            await self._fan_out(event["message"], event["participants"])
+        elif kind == "user":
+            await self.send_local(event["message"], event["user_id"])
+        elif kind == "status":
+            self.presence.handle_event(event)
+        elif kind == "dm_created":
+            directory_cache.add_dm(event["dm_id"], event["participants"])
+            self.add_peers(event["participants"])
+        elif kind == "join_server":
+            directory_cache.invalidate_user(event["user_id"])
+            self.join_server(event["user_id"], event["server_id"])
+        elif kind == "add_channel":
+            directory_cache.add_channel(event["channel_id"], event["server_id"])
+            self.add_channel(event["channel_id"], event["server_id"])
+        elif kind == "remove_server":
+            directory_cache.invalidate_server(event["server_id"])
+            self.remove_server(event["server_id"])
+        elif kind == "flush_stats":
+            await stats_counters.flush()
+        elif kind == "end_session":
+            principal_cache.invalidate_session(event["session_token"])
+        elif kind == "evict":
+            principal_cache.invalidate_user(event["user_id"], sessions=True)
+            directory_cache.invalidate_user(event["user_id"])
+            directory_cache.remove_dms(event.get("dm_ids", []))
+            websocket = self.active_connections.get(event["user_id"])
+            if websocket is not None:
+                self._drop(event["user_id"])
+                try:
+                    await websocket.close(code=1008)
+                except Exception:
+                    pass
+
+    # Directory changes are invalidated here right away and on every worker by the event
+    async def member_joined(self, user_id: str, server_id: str):
+        directory_cache.invalidate_user(user_id)
+        await self.broker.publish({"kind": "join_server", "user_id": user_id, "server_id": server_id})
+
+    async def channel_created(self, channel_id: str, server_id: str):
+        directory_cache.add_channel(channel_id, server_id)
+        await self.broker.publish({"kind": "add_channel", "channel_id": channel_id, "server_id": server_id})
+
+    async def server_removed(self, server_id: str):
+        directory_cache.invalidate_server(server_id)
+        await self.broker.publish({"kind": "remove_server", "server_id": server_id})
+
+    async def evict_user(self, user_id: str, dm_ids: List[str] = ()):
+        # Close the user's socket and drop cached credentials and DMs on every worker
+        principal_cache.invalidate_user(user_id, sessions=True)
+        directory_cache.invalidate_user(user_id)
+        directory_cache.remove_dms(dm_ids)
+        await self.broker.publish({"kind": "evict", "user_id": user_id, "dm_ids": list(dm_ids)})
+
+    async def session_ended(self, session_token: str):
+        # Logged-out sessions must stop authenticating on every worker, not only this one
+        principal_cache.invalidate_session(session_token)
+        await self.broker.publish({"kind": "end_session", "session_token": session_token})
 
-    async def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-        self.user_status[user_id] = "offline"
-        await self.broadcast_status_update(user_id, "offline")
+    async def dm_created(self, dm_id: str, participants: List[str]):
+        directory_cache.add_dm(dm_id, participants)
+        await self.broker.publish({"kind": "dm_created", "dm_id": dm_id, "participants": participants})
+
+    async def load_subscriptions(self, user_id: str):
+        server_ids = list(await directory_cache.servers_for(user_id))
+        for server_id in server_ids:
+            channels = await directory_cache.channels_for(server_id)
+            self.server_channels.setdefault(server_id, set()).update(channel["id"] for channel in channels)
+        for server_id in server_ids:
+            self.join_server(user_id, server_id)
+        dms = await db.direct_messages.find({"participants": user_id}, {"_id": 0, "participants": 1}).to_list(10000)
+        self.user_peers[user_id] = {p for dm in dms for p in dm["participants"] if p != user_id}
+
+    def add_peers(self, participants: List[str]):
+        for user_id in participants:
+            if user_id in self.active_connections:
+                self.user_peers.setdefault(user_id, set()).update(p for p in participants if p != user_id)
+
+    def join_server(self, user_id: str, server_id: str):
+        if user_id not in self.active_connections:
+            return
+        self.user_servers.setdefault(user_id, set()).add(server_id)
+        self.server_subscribers.setdefault(server_id, set()).add(user_id)
+        for channel_id in self.server_channels.get(server_id, ()):
+            self.channel_subscribers.setdefault(channel_id, set()).add(user_id)
+
+    def leave_server(self, user_id: str, server_id: str):
+        self.user_servers.get(user_id, set()).discard(server_id)
+        for channel_id in self.server_channels.get(server_id, ()):
+            self._discard_subscriber(channel_id, user_id)
+        subscribers = self.server_subscribers.get(server_id)
+        if subscribers is not None:
+            subscribers.discard(user_id)
+            if not subscribers:
+                del self.server_subscribers[server_id]
+                self.server_channels.pop(server_id, None)
+
+    def add_channel(self, channel_id: str, server_id: str):
+        subscribers = self.server_subscribers.get(server_id)
+        if not subscribers:
+            return
+        self.server_channels.setdefault(server_id, set()).add(channel_id)
+        self.channel_subscribers.setdefault(channel_id, set()).update(subscribers)
+
+    def remove_server(self, server_id: str):
+        for user_id in self.server_subscribers.pop(server_id, set()):
+            self.user_servers.get(user_id, set()).discard(server_id)
+        for channel_id in self.server_channels.pop(server_id, set()):
+            self.channel_subscribers.pop(channel_id, None)
+
+    def unsubscribe_user(self, user_id: str):
+        for server_id in list(self.user_servers.pop(user_id, ())):
+            self.leave_server(user_id, server_id)
+
+    def _discard_subscriber(self, channel_id: str, user_id: str):
+        subscribers = self.channel_subscribers.get(channel_id)
+        if subscribers is not None:
+            subscribers.discard(user_id)
+            if not subscribers:
+                del self.channel_subscribers[channel_id]
+
+    async def _send(self, user_id: str, websocket: WebSocket, message: dict) -> bool:
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(websocket.send_json(message), WS_SEND_TIMEOUT)
+            WS_SEND_DURATION.observe(time.perf_counter() - start)
+            WS_FRAMES.labels("out", message.get("type", "unknown")).inc()
+            return True
+        except Exception as e:
+            WS_SEND_FAILURES.inc()
+            logger.debug(f"WebSocket send to {user_id} failed: {e!r}")
+            # Slow or dead socket, drop it unless it has already been replaced. Closing it makes
+            # the client reconnect and resume instead of sitting on a socket that gets nothing.
+            if self.active_connections.get(user_id) is websocket:
+                self._drop(user_id)
+                asyncio.create_task(self._close(websocket, 1013))
+            return False
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    async def _fan_out(self, message: dict, user_ids):
+        targets = [(uid, self.active_connections[uid]) for uid in user_ids if uid in self.active_connections]
+        if targets:
+            await asyncio.gather(*(self._send(uid, ws, message) for uid, ws in targets))
+
+    async def send_local(self, message: dict, user_id: str):
+        websocket = self.active_connections.get(user_id)
+        if websocket is not None:
+            await self._send(user_id, websocket, message)
 
     async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_json(message)
-            except:
-                pass
+        await self.broker.publish({"kind": "user", "user_id": user_id, "message": message})
 
-    async def broadcast_to_channel(self, message: dict, channel_id: str):
-        for user_id, websocket in self.active_connections.items():
-            try:
-                await websocket.send_json(message)
-            except:
-                pass
+    async def broadcast_to_channel(self, message: dict, channel_id: str, seq: Optional[int] = None):
+        event = {"kind": "channel", "channel_id": channel_id, "message": message}
+        if seq is not None:
+            event["seq"] = seq
+        await self.broker.publish(event)
 
-    async def broadcast_status_update(self, user_id: str, status: str):
-        message = {"type": "status_update", "user_id": user_id, "status": status}
-        for websocket in self.active_connections.values():
-            try:
-                await websocket.send_json(message)
-            except:
-                pass
+    async def broadcast_to_dm(self, message: dict, dm_id: str, participants: List[str], seq: int):
+        await self.broker.publish({"kind": "dm", "dm_id": dm_id, "participants": participants, "seq": seq, "message": message})
+
+    def record(self, stream_id: str, seq: int, message: dict):
+        buffer = self.replay.get(stream_id)
+        if buffer is None:
+            buffer = self.replay[stream_id] = deque(maxlen=REPLAY_BUFFER_SIZE)
+        buffer.append((seq, message))
 
-manager = ConnectionManager()
+    async def resume(self, user_id: str, streams: Dict[str, int]):
+        # Replay what a reconnecting client missed, or tell it to refetch when the gap left the buffer
+        for stream_id, last_seq in streams.items():
+            if not isinstance(last_seq, int):
+                continue
+            if user_id not in self.channel_subscribers.get(stream_id, ()):
+                if user_id not in (await directory_cache.dm_participants(stream_id) or ()):
+                    continue
+            buffer = self.replay.get(stream_id)
+            if buffer and min(seq for seq, _ in buffer) <= last_seq + 1:
+                for seq, message in sorted((e for e in buffer if e[0] > last_seq), key=lambda e: e[0]):
+                    await self.send_local(message, user_id)
+            elif await current_seq(stream_id) > last_seq:
+                await self.send_local({"type": "resume_gap", "stream_id": stream_id, "last_seq": last_seq}, user_id)
+        await self.send_local({"type": "resumed"}, user_id)
 
-# Create the main app
-app = FastAPI()
+manager = ConnectionManager(create_broker(WS_BROKER_URL))
+
+# Create the main app. ORJSONResponse serializes datetimes natively and much faster than
+# the stdlib encoder; hot read endpoints return it directly to skip jsonable_encoder too.
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 
 # Models
@@ -155,28 +898,741 @@ class ActivityLog(BaseModel):
     details: Dict[str, Any]
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+# Caches session_token -> (user_id, expires_at) and user_id -> User so that
+# authenticated requests usually need no database round trip
+class PrincipalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.sessions: TTLCache = TTLCache(maxsize, ttl)
+        self.users: TTLCache = TTLCache(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get_session(self, session_token: str):
+        session = self.sessions.get(session_token)
+        if session is None or session[1] <= datetime.now(timezone.utc):
+            return None
+        return session[0]
+
+    def set_session(self, session_token: str, user_id: str, expires_at: datetime):
+        self.sessions[session_token] = (user_id, expires_at)
+
+    def get_user(self, user_id: str) -> Optional[User]:
+        user = self.users.get(user_id)
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    def set_user(self, user: User):
+        self.users[user.id] = user
+
+    def invalidate_session(self, session_token: str):
+        self.sessions.pop(session_token, None)
+
+    def invalidate_user(self, user_id: str, sessions: bool = False):
+        self.users.pop(user_id, None)
+        if sessions:
+            for token, (session_user_id, _) in list(self.sessions.items()):
+                if session_user_id == user_id:
+                    self.sessions.pop(token, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "sessions": len(self.sessions), "users": len(self.users)}
+
+principal_cache = PrincipalCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+# Token buckets keyed by (user_id, action). An idle bucket refills completely, so buckets
+# expire after being idle long enough to be full again and the LRU bound caps memory.
+class RateLimiter:
+    def __init__(self, limits: Dict[str, tuple], maxsize: int):
+        self.limits = limits
+        refill = max((burst / rate for rate, burst in limits.values()), default=1)
+        self.buckets: TTLCache = TTLCache(maxsize, refill)  # (user_id, action): (tokens, updated_at)
+
+    def acquire(self, user_id: str, action: str) -> float:
+        # Returns 0 when allowed, otherwise the seconds until a token is available
+        if action not in self.limits:
+            return 0
+        rate, burst = self.limits[action]
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.get((user_id, action), (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        if tokens < 1:
+            self.buckets[(user_id, action)] = (tokens, now)
+            RATE_LIMITED.labels(action).inc()
+            return (1 - tokens) / rate
+        self.buckets[(user_id, action)] = (tokens - 1, now)
+        return 0
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_MAX_KEYS)
+
+# Caches user_id -> {server_id: server} and server_id -> [channel]. A user miss loads the
+# servers and their channels in one aggregation. Entries are dropped when servers,
+# channels or memberships change; a generation counter stops a load that raced with an
+# invalidation from storing stale data. A new channel only drops its server's channel list,
+# stamped with a channel counter so a racing load skips just that server. channel_id -> server_id and dm_id -> participants
+# never change once created and are cached on their own, including ids that turned out
+# not to be a channel/DM, so membership checks on either kind of stream stay in memory.
+MISSING = object()
+
+class DirectoryCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.user_servers: TTLCache = TTLCache(maxsize, ttl)
+        self.server_channels: TTLCache = TTLCache(maxsize, ttl)
+        self.channel_servers: TTLCache = TTLCache(maxsize, ttl)  # channel_id: server_id, None when not a channel
+        self.dm_members: TTLCache = TTLCache(maxsize, ttl)  # dm_id: participants, None when not a DM
+        self.generation = 0
+        self.channel_generation = 0
+        self.channels_changed: TTLCache = TTLCache(maxsize, ttl)  # server_id: channel_generation of its last new channel
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, cache: str, value, missing=None):
+        result = "miss" if value is missing else "hit"
+        DIRECTORY_LOOKUPS.labels(cache, result).inc()
+        if value is missing:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def _store_channels(self, server_id: str, channels: List[dict], generation: int, channel_generation: int):
+        for channel in channels:
+            self.channel_servers[channel["id"]] = server_id
+        if generation == self.generation and self.channels_changed.get(server_id, 0) <= channel_generation:
+            self.server_channels[server_id] = channels
+
+    async def servers_for(self, user_id: str) -> Dict[str, dict]:
+        servers = self._lookup("servers", self.user_servers.get(user_id))
+        if servers is not None:
+            return servers
+        generation, channel_generation = self.generation, self.channel_generation
+        docs = await db.server_members.aggregate([
+            {"$match": {"user_id": user_id}},
+            {"$lookup": {"from": "servers", "localField": "server_id", "foreignField": "id", "as": "server"}},
+            {"$unwind": "$server"},
+            {"$lookup": {"from": "channels", "localField": "server_id", "foreignField": "server_id", "as": "channels"}},
+            {"$project": {"_id": 0, "server": 1, "channels": 1}},
+        ]).to_list(None)
+        servers = {}
+        for doc in docs:
+            server = doc["server"]
+            server.pop("_id", None)
+            for channel in doc["channels"]:
+                channel.pop("_id", None)
+            servers[server["id"]] = server
+            self._store_channels(server["id"], doc["channels"], generation, channel_generation)
+        if generation == self.generation:
+            self.user_servers[user_id] = servers
+        return servers
+
+    async def channels_for(self, server_id: str) -> List[dict]:
+        channels = self._lookup("channels", self.server_channels.get(server_id))
+        if channels is not None:
+            return channels
+        generation, channel_generation = self.generation, self.channel_generation
+        channels = await db.channels.find({"server_id": server_id}, {"_id": 0}).to_list(None)
+        self._store_channels(server_id, channels, generation, channel_generation)
+        return channels
+
+    async def channel_server(self, channel_id: str) -> Optional[str]:
+        server_id = self._lookup("channel_server", self.channel_servers.get(channel_id, MISSING), MISSING)
+        if server_id is MISSING:
+            channel = await db.channels.find_one({"id": channel_id}, {"_id": 0, "server_id": 1})
+            server_id = self.channel_servers[channel_id] = channel["server_id"] if channel else None
+        return server_id
+
+    async def dm_participants(self, dm_id: str) -> Optional[List[str]]:
+        participants = self._lookup("dms", self.dm_members.get(dm_id, MISSING), MISSING)
+        if participants is MISSING:
+            generation = self.generation
+            dm = await db.direct_messages.find_one({"id": dm_id}, {"_id": 0, "participants": 1})
+            participants = dm["participants"] if dm else None
+            if generation == self.generation:
+                self.dm_members[dm_id] = participants
+        return participants
+
+    async def user_channels(self, user_id: str) -> List[dict]:
+        channels = []
+        for server_id in await self.servers_for(user_id):
+            channels += await self.channels_for(server_id)
+        return channels
+
+    async def is_member(self, user_id: str, server_id: Optional[str]) -> bool:
+        return server_id in await self.servers_for(user_id)
+
+    def add_channel(self, channel_id: str, server_id: str):
+        # user_servers holds no channels, so only this server's channel list goes stale
+        self.channel_generation += 1
+        self.channels_changed[server_id] = self.channel_generation
+        self.server_channels.pop(server_id, None)
+        self.channel_servers[channel_id] = server_id
+
+    def add_dm(self, dm_id: str, participants: List[str]):
+        self.dm_members[dm_id] = participants
+
+    def remove_dms(self, dm_ids: List[str]):
+        self.generation += 1
+        for dm_id in dm_ids:
+            self.dm_members.pop(dm_id, None)
+
+    def invalidate_user(self, user_id: str):
+        self.generation += 1
+        self.user_servers.pop(user_id, None)
+
+    def invalidate_server(self, server_id: str):
+        self.generation += 1
+        self.server_channels.pop(server_id, None)
+        for user_id, servers in list(self.user_servers.items()):
+            if server_id in servers:
+                self.user_servers.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "users": len(self.user_servers), "servers": len(self.server_channels),
+            "channels": len(self.channel_servers), "dms": len(self.dm_members)
+        }
+
+directory_cache = DirectoryCache(DIRECTORY_CACHE_SIZE, DIRECTORY_CACHE_TTL)
+
+# Buffers activity log documents in memory and writes them with insert_many,
+# flushing when a batch fills up or the flush interval elapses
+class ActivityLogger:
+    def __init__(self, maxsize: int, batch_size: int, flush_interval: float):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Created in start() so they bind to the running event loop
+        self.queue: Optional[asyncio.Queue] = None
+        self.batch_ready: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        if self.task is None:
+            self.queue = asyncio.Queue(maxsize=self.maxsize)
+            self.batch_ready = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Flush everything queued so far and stop the writer
+        if self.task is not None:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def log(self, doc: dict):
+        if self.task is None:
+            await db.activity_logs.insert_one(doc)
+            return
+        try:
+            self.queue.put_nowait(doc)
+        except asyncio.QueueFull:
+            # Backpressure: wait briefly for the writer to make room, then drop
+            try:
+                await asyncio.wait_for(self.queue.put(doc), ACTIVITY_BACKPRESSURE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                return
+        if self.queue.qsize() >= self.batch_size:
+            self.batch_ready.set()
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if batch[0] is not None and self.queue.qsize() < self.batch_size - 1:
+                self.batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self.batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            stopping = None in batch
+            await self._flush([doc for doc in batch if doc is not None])
+            if stopping:
+                remaining = []
+                while not self.queue.empty():
+                    doc = self.queue.get_nowait()
+                    if doc is not None:
+                        remaining.append(doc)
+                await self._flush(remaining)
+                return
+
+    async def _flush(self, docs: List[dict]):
+        if not docs:
+            return
+        try:
+            await db.activity_logs.insert_many(docs, ordered=False)
+            self.written += len(docs)
+        except Exception as e:
+            self.failed += len(docs)
+            logger.error(f"Failed to write {len(docs)} activity log entries: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {"queue_depth": self.queue.qsize() if self.queue else 0, "written": self.written, "dropped": self.dropped, "failed": self.failed}
+
+activity_logger = ActivityLogger(ACTIVITY_QUEUE_SIZE, ACTIVITY_BATCH_SIZE, ACTIVITY_FLUSH_INTERVAL)
+
+# Counters kept up to date with $inc on the write paths so admin stats never count
+# collections: stats {_id: "totals"}, daily_stats {_id: "YYYY-MM-DD"} and
+# server_stats {_id: server_id}. Message counts are buffered in memory and flushed in
+# bulk every STATS_FLUSH_INTERVAL so sends do not wait on them. Totals, the displayed
+# days and per-server counts are periodically reconciled with real counts.
+class StatsCounters:
+    def __init__(self, reconcile_interval: float, flush_interval: float):
+        self.reconcile_interval = reconcile_interval
+        self.flush_interval = flush_interval
+        self.pending: Dict[tuple, dict] = {}  # (collection, _id): {"messages": n, "last_message_at": ts}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def incr(self, **amounts: int):
+        await db.stats.update_one({"_id": "totals"}, {"$inc": amounts}, upsert=True)
+
+    def record_message(self, server_id: Optional[str], timestamp: Optional[datetime], amount: int = 1):
+        # amount is negative for deletions; the day is unknown for some archived messages
+        keys = [("stats", "totals")]
+        if timestamp is not None:
+            keys.append(("daily_stats", timestamp.date().isoformat()))
+        if server_id:
+            keys.append(("server_stats", server_id))
+        for key in keys:
+            entry = self.pending.setdefault(key, {"messages": 0})
+            entry["messages"] += amount
+            if key[0] == "server_stats" and amount > 0:
+                entry["last_message_at"] = max(entry.get("last_message_at", timestamp), timestamp)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        ops: Dict[str, list] = {}
+        for (collection, key), entry in pending.items():
+            if not entry["messages"]:
+                continue
+            update: Dict[str, Any] = {"$inc": {"messages": entry["messages"]}}
+            if "last_message_at" in entry:
+                update["$max"] = {"last_message_at": entry["last_message_at"]}
+            # Decrements never create documents, e.g. for a server deleted meanwhile
+            ops.setdefault(collection, []).append(UpdateOne({"_id": key}, update, upsert=entry["messages"] > 0))
+        for collection, updates in ops.items():
+            try:
+                await db[collection].bulk_write(updates, ordered=False)
+            except Exception as e:
+                logger.error(f"Failed to write {len(updates)} {collection} counter updates: {e}")
+
+    async def _claim(self) -> bool:
+        # One reconciliation per interval across all workers, whichever claims the lease first
+        now = datetime.now(timezone.utc)
+        try:
+            await db.stats.find_one_and_update(
+                {"_id": "reconcile_lease", "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]},
+                {"$set": {"locked_until": now + timedelta(seconds=self.reconcile_interval)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def reconcile(self):
+        # Every worker flushes first, so buffered increments for messages the counts below
+        # include are not added on top of them afterwards
+        await manager.broker.publish({"kind": "flush_stats"})
+        await asyncio.sleep(self.flush_interval)
+        totals = {
+            "users": await db.users.count_documents({}),
+            "servers": await db.servers.count_documents({}),
+            "messages": await db.messages.count_documents({}) + await message_archive.count(),
+        }
+        await db.stats.update_one({"_id": "totals"}, {"$set": {**totals, "reconciled_at": datetime.now(timezone.utc)}}, upsert=True)
+        await self.reconcile_daily()
+        await self.reconcile_servers()
+
+    async def reconcile_daily(self):
+        # Only the days the admin stats show; older days are never read
+        today = datetime.now(timezone.utc).date()
+        days = [(today - timedelta(days=i)).isoformat() for i in range(STATS_DAYS)]
+        since = datetime.fromisoformat(days[-1]).replace(tzinfo=timezone.utc)
+        counts = dict.fromkeys(days, 0)
+        hot = await db.messages.aggregate([
+            {"$match": {"timestamp": {"$gte": since}}},
+            {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}}, "messages": {"$sum": 1}}},
+        ]).to_list(None)
+        for day in hot:
+            counts[day["_id"]] = counts.get(day["_id"], 0) + day["messages"]
+        for message in await message_archive.messages_since(since):
+            day = message["timestamp"].date().isoformat()
+            counts[day] = counts.get(day, 0) + 1
+        await db.daily_stats.bulk_write([UpdateOne({"_id": day}, {"$set": {"messages": n}}, upsert=True) for day, n in counts.items()], ordered=False)
+
+    async def reconcile_servers(self):
+        per_channel = await db.messages.aggregate([
+            {"$match": {"channel_id": {"$ne": None}}},
+            {"$group": {"_id": "$channel_id", "messages": {"$sum": 1}, "last_message_at": {"$max": "$timestamp"}}},
+        ]).to_list(None)
+        per_channel += await db.message_segments.aggregate([
+            {"$match": {"field": "channel_id"}},
+            {"$group": {"_id": "$stream_id", "messages": {"$sum": "$count"}, "last_message_at": {"$max": "$last_ts"}}},
+        ]).to_list(None)
+        channels = await fetch_by_ids(db.channels, [c["_id"] for c in per_channel], {"server_id": 1})
+        servers: Dict[str, dict] = {}
+        for entry in per_channel:
+            channel = channels.get(entry["_id"])
+            if not channel:
+                continue
+            server = servers.setdefault(channel["server_id"], {"messages": 0, "last_message_at": entry["last_message_at"]})
+            server["messages"] += entry["messages"]
+            server["last_message_at"] = max(server["last_message_at"], entry["last_message_at"])
+        await db.server_stats.delete_many({"_id": {"$nin": list(servers)}})
+        if servers:
+            await db.server_stats.bulk_write([UpdateOne({"_id": server_id}, {"$set": counts}, upsert=True) for server_id, counts in servers.items()], ordered=False)
+
+    async def _run(self):
+        if not await db.stats.find_one({"_id": "totals"}, {"_id": 1}) and await self._claim():
+            await self.reconcile()
+        last_reconcile = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_reconcile >= self.reconcile_interval:
+                    last_reconcile = time.monotonic()
+                    if await self._claim():
+                        await self.reconcile()
+            except Exception as e:
+                logger.error(f"Stats flush or reconciliation failed: {e}")
+
+    async def snapshot(self) -> Dict[str, Any]:
+        today = datetime.now(timezone.utc).date()
+        days = [(today - timedelta(days=i)).isoformat() for i in range(STATS_DAYS)]
+        totals, daily, servers = await asyncio.gather(
+            db.stats.find_one({"_id": "totals"}),
+            db.daily_stats.find({"_id": {"$in": days}}).to_list(STATS_DAYS),
+            db.server_stats.find({}).sort("messages", DESCENDING).limit(STATS_TOP_SERVERS).to_list(STATS_TOP_SERVERS),
+        )
+        daily_counts = {d["_id"]: d.get("messages", 0) for d in daily}
+        return {
+            "totals": totals or {},
+            "daily_messages": [{"date": day, "messages": daily_counts.get(day, 0)} for day in days],
+            "top_servers": [{"server_id": s["_id"], "messages": s.get("messages", 0), "last_message_at": s.get("last_message_at")} for s in servers],
+        }
+
+stats_counters = StatsCounters(STATS_RECONCILE_INTERVAL, STATS_FLUSH_INTERVAL)
+
+# Removes dependent data of deleted users/servers in the background. A job is a list of
+# {collection, filter} steps deleted DELETE_BATCH_SIZE documents at a time with a pause
+# between batches. Progress is saved after every batch and jobs are claimed with a lease,
+# so an interrupted job is picked up again after a restart or by another worker.
+class DeletionJobs:
+    def __init__(self, batch_size: int, batch_delay: float):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def enqueue(self, kind: str, target_id: str, steps: List[Dict[str, Any]]) -> str:
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()), "kind": kind, "target_id": target_id,
+            "steps": steps, "step": 0, "deleted": {}, "status": "pending",
+            "locked_until": None, "error": None, "created_at": now, "updated_at": now
+        }
+        await db.deletion_jobs.insert_one(job)
+        return job["id"]
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await db.deletion_jobs.find_one_and_update(
+            {"status": {"$in": ["pending", "running"]}, "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]},
+            {"$set": {"status": "running", "locked_until": now + timedelta(seconds=DELETE_LEASE_SECONDS)}},
+            sort=[("created_at", ASCENDING)], return_document=ReturnDocument.AFTER
+        )
+
+    async def _run(self):
+        while True:
+            try:
+                job = await self._claim()
+                if job is None:
+                    await asyncio.sleep(DELETE_POLL_INTERVAL)
+                else:
+                    await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Deletion worker error: {e}")
+                await asyncio.sleep(DELETE_POLL_INTERVAL)
+
+    async def _process(self, job: dict):
+        steps, step, deleted = job["steps"], job["step"], job["deleted"]
+        try:
+            while step < len(steps):
+                collection, query = steps[step]["collection"], steps[step]["filter"]
+                if collection == "message_segments":
+                    # Archived messages, counted in messages rather than segments
+                    matched, removed_per_stream = await message_archive.purge(query, steps[step].get("user_id"))
+                    exhausted = matched < ARCHIVE_PURGE_BATCH
+                    for stream_id, count in removed_per_stream.items():
+                        stats_counters.record_message(await directory_cache.channel_server(stream_id), None, -count)
+                    removed = sum(removed_per_stream.values())
+                else:
+                    projection = {"_id": 1, "channel_id": 1, "timestamp": 1} if collection == "messages" else {"_id": 1}
+                    batch = await db[collection].find(query, projection).limit(self.batch_size).to_list(self.batch_size)
+                    removed = 0
+                    if batch:
+                        result = await db[collection].delete_many({"_id": {"$in": [d["_id"] for d in batch]}})
+                        removed = result.deleted_count
+                    exhausted = len(batch) < self.batch_size
+                    if collection == "messages":
+                        for doc in batch:
+                            server_id = await directory_cache.channel_server(doc["channel_id"]) if doc.get("channel_id") else None
+                            stats_counters.record_message(server_id, doc["timestamp"], -1)
+                deleted[collection] = deleted.get(collection, 0) + removed
+                if exhausted:
+                    step += 1
+                now = datetime.now(timezone.utc)
+                await db.deletion_jobs.update_one({"id": job["id"]}, {"$set": {
+                    "step": step, "deleted": deleted, "updated_at": now,
+                    "locked_until": now + timedelta(seconds=DELETE_LEASE_SECONDS)
+                }})
+                await asyncio.sleep(self.batch_delay)
+            status, error = "done", None
+        except Exception as e:
+            logger.error(f"Deletion job {job['id']} failed: {e}")
+            status, error = "failed", str(e)
+        await db.deletion_jobs.update_one({"id": job["id"]}, {"$set": {
+            "status": status, "error": error, "locked_until": None, "updated_at": datetime.now(timezone.utc)
+        }})
+
+deletion_jobs = DeletionJobs(DELETE_BATCH_SIZE, DELETE_BATCH_DELAY)
+
+# Cold tier for old messages. Each channel/DM is archived oldest first into append-only
+# segments of up to ARCHIVE_SEGMENT_SIZE messages, stored zlib-compressed in
+# message_segments with their (timestamp, id) range, message count and authors as the
+# segment index. Archiving always takes the oldest hot messages, so every archived message
+# sorts before every hot one and history pages continue from the hot into the cold tier.
+class MessageArchive:
+    def __init__(self, after_days: float, segment_size: int, interval: float):
+        self.after_days = after_days
+        self.segment_size = segment_size
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+        self.last_run_at: Optional[datetime] = None
+        self.last_archived = 0
+
+    def start(self):
+        if self.task is None and self.after_days > 0:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            try:
+                self.last_archived = await self.archive()
+                self.last_run_at = datetime.now(timezone.utc)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Message archiving failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def encode(messages: List[dict]) -> bytes:
+        return zlib.compress(orjson.dumps(messages))
+
+    @staticmethod
+    def decode(data: bytes) -> List[dict]:
+        messages = orjson.loads(zlib.decompress(data))
+        for message in messages:
+            message["timestamp"] = datetime.fromisoformat(message["timestamp"])
+        return messages
+
+    def segment(self, stream_id: str, field: str, messages: List[dict]) -> dict:
+        first, last = messages[0], messages[-1]
+        return {
+            "stream_id": stream_id, "field": field,
+            "first_ts": first["timestamp"], "first_id": first["id"],
+            "last_ts": last["timestamp"], "last_id": last["id"],
+            "count": len(messages), "user_ids": sorted({m["user_id"] for m in messages}),
+            "data": self.encode(messages)
+        }
+
+    async def archive(self) -> int:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.after_days)
+        archived = 0
+        for field in ("channel_id", "dm_id"):
+            for stream_id in await db.messages.distinct(field, {"timestamp": {"$lt": cutoff}}):
+                if stream_id:
+                    archived += await self.archive_stream(field, stream_id, cutoff)
+        return archived
+
+    async def archive_stream(self, field: str, stream_id: str, cutoff: datetime) -> int:
+        archived = 0
+        while True:
+            messages = await db.messages.find(
+                {field: stream_id, "timestamp": {"$lt": cutoff}}, {"_id": 0}
+            ).sort([("timestamp", 1), ("id", 1)]).limit(self.segment_size).to_list(self.segment_size)
+            if not messages:
+                return archived
+            segment_id = f"{stream_id}:{messages[0]['timestamp'].isoformat()}:{messages[0]['id']}"
+            try:
+                await db.message_segments.insert_one({
+                    "_id": segment_id, **self.segment(stream_id, field, messages), "created_at": datetime.now(timezone.utc)
+                })
+            except DuplicateKeyError:
+                # Written by an interrupted run; only its first `count` messages are in it
+                existing = await db.message_segments.find_one({"_id": segment_id}, {"count": 1})
+                messages = messages[:existing["count"]]
+            await db.messages.delete_many({"id": {"$in": [m["id"] for m in messages]}})
+            archived += len(messages)
+            if len(messages) < self.segment_size:
+                return archived
+            await asyncio.sleep(ARCHIVE_BATCH_DELAY)
+
+    async def read(self, stream_id: str, cursor: Optional[tuple], direction: int, limit: int) -> List[dict]:
+        # Up to `limit` archived messages past the (timestamp, id) cursor, newest first when direction is -1
+        query: Dict[str, Any] = {"stream_id": stream_id}
+        if direction == -1:
+            if cursor:
+                query["first_ts"] = {"$lte": cursor[0]}
+            segments = db.message_segments.find(query, {"data": 1}).sort("last_ts", DESCENDING)
+        else:
+            if cursor:
+                query["last_ts"] = {"$gte": cursor[0]}
+            segments = db.message_segments.find(query, {"data": 1}).sort("first_ts", ASCENDING)
+        messages = []
+        try:
+            async for segment in segments:
+                decoded = self.decode(segment["data"])
+                if direction == -1:
+                    decoded.reverse()
+                for message in decoded:
+                    key = (message["timestamp"], message["id"])
+                    if cursor and (key >= cursor if direction == -1 else key <= cursor):
+                        continue
+                    messages.append(message)
+                    if len(messages) == limit:
+                        return messages
+            return messages
+        finally:
+            await segments.close()
+
+    async def purge(self, query: dict, user_id: Optional[str] = None):
+        # Deletes matching segments, or only user_id's messages from them; returns
+        # (segments matched, {stream_id: messages removed})
+        removed: Dict[str, int] = {}
+        if user_id is None:
+            segments = await db.message_segments.find(query, {"count": 1, "stream_id": 1}).limit(ARCHIVE_PURGE_BATCH).to_list(ARCHIVE_PURGE_BATCH)
+            if segments:
+                await db.message_segments.delete_many({"_id": {"$in": [s["_id"] for s in segments]}})
+            for segment in segments:
+                removed[segment["stream_id"]] = removed.get(segment["stream_id"], 0) + segment["count"]
+            return len(segments), removed
+        segments = await db.message_segments.find({**query, "user_ids": user_id}).limit(ARCHIVE_PURGE_BATCH).to_list(ARCHIVE_PURGE_BATCH)
+        for segment in segments:
+            messages = self.decode(segment["data"])
+            kept = [m for m in messages if m["user_id"] != user_id]
+            removed[segment["stream_id"]] = removed.get(segment["stream_id"], 0) + len(messages) - len(kept)
+            await self.rewrite(segment, kept)
+        return len(segments), removed
+
+    async def remove(self, stream_id: str, timestamp: datetime, message_id: str) -> Optional[dict]:
+        # Deletes one archived message from the segment(s) whose range covers its timestamp
+        segments = await db.message_segments.find(
+            {"stream_id": stream_id, "first_ts": {"$lte": timestamp}, "last_ts": {"$gte": timestamp}}
+        ).to_list(None)
+        for segment in segments:
+            messages = self.decode(segment["data"])
+            kept = [m for m in messages if m["id"] != message_id]
+            if len(kept) < len(messages):
+                await self.rewrite(segment, kept)
+                return next(m for m in messages if m["id"] == message_id)
+        return None
+
+    async def rewrite(self, segment: dict, kept: List[dict]):
+        if kept:
+            await db.message_segments.update_one({"_id": segment["_id"]}, {"$set": self.segment(segment["stream_id"], segment["field"], kept)})
+        else:
+            await db.message_segments.delete_one({"_id": segment["_id"]})
+
+    async def messages_since(self, since: datetime) -> List[dict]:
+        # Archived messages newer than `since`, only non-empty when ARCHIVE_AFTER_DAYS is short
+        messages = []
+        async for segment in db.message_segments.find({"last_ts": {"$gte": since}}, {"data": 1}):
+            messages += [m for m in self.decode(segment["data"]) if m["timestamp"] >= since]
+        return messages
+
+    async def count(self) -> int:
+        result = await db.message_segments.aggregate([{"$group": {"_id": None, "messages": {"$sum": "$count"}}}]).to_list(1)
+        return result[0]["messages"] if result else 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"after_days": self.after_days, "last_run_at": self.last_run_at, "last_archived": self.last_archived}
+
+message_archive = MessageArchive(ARCHIVE_AFTER_DAYS, ARCHIVE_SEGMENT_SIZE, ARCHIVE_INTERVAL)
+
 # Helper functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.hash, password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.verify, plain_password, hashed_password)
 
 def create_jwt_token(user_id: str) -> str:
     expire = datetime.now(timezone.utc) + timedelta(days=7)
     payload = {"user_id": user_id, "exp": expire}
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
+async def load_user(user_id: str) -> Optional[User]:
+    user = principal_cache.get_user(user_id)
+    if user is None:
+        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if user_doc:
+            user = User(**user_doc)
+            principal_cache.set_user(user)
+    return user
+
 async def get_current_user(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     token = None
     
     # Check session_token from cookie first
     if session_token:
-        session = await db.user_sessions.find_one({"session_token": session_token})
-        if session and session["expires_at"] > datetime.now(timezone.utc):
-            user = await db.users.find_one({"id": session["user_id"]}, {"_id": 0})
+        user_id = principal_cache.get_session(session_token)
+        if user_id is None:
+            session = await db.user_sessions.find_one({"session_token": session_token})
+            if session and session["expires_at"] > datetime.now(timezone.utc):
+                user_id = session["user_id"]
+                principal_cache.set_session(session_token, user_id, session["expires_at"])
+        if user_id:
+            user = await load_user(user_id)
             if user:
-                return User(**user)
+                return user
     
     # Fallback to Authorization header
     if authorization and authorization.startswith("Bearer "):
@@ -185,9 +1641,9 @@ async def get_current_user(authorization: Optional[str] = Header(None), session_
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             user_id = payload.get("user_id")
             if user_id:
-                user = await db.users.find_one({"id": user_id}, {"_id": 0})
+                user = await load_user(user_id)
                 if user:
-                    return User(**user)
+                    return user
         except jwt.InvalidTokenError:
             pass
     
@@ -199,11 +1655,118 @@ async def get_admin_user(authorization: Optional[str] = Header(None), session_to
         raise HTTPException(status_code=403, detail="Admin access required")
     return user
 
+async def require_member(user: User, server_id: Optional[str]):
+    if not await directory_cache.is_member(user.id, server_id):
+        raise HTTPException(status_code=404, detail="Server not found")
+
+async def require_channel_member(user: User, channel_id: str) -> str:
+    server_id = await directory_cache.channel_server(channel_id)
+    if not await directory_cache.is_member(user.id, server_id):
+        raise HTTPException(status_code=404, detail="Channel not found")
+    return server_id
+
+def check_rate_limit(user_id: str, action: str):
+    retry_after = rate_limiter.acquire(user_id, action)
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded", headers={"Retry-After": str(max(1, round(retry_after)))})
+
 async def log_activity(user_id: str, action: str, details: Dict[str, Any]):
     activity = ActivityLog(user_id=user_id, action=action, details=details)
     doc = activity.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
-    await db.activity_logs.insert_one(doc)
+    await activity_logger.log(doc)
+
+async def next_seq(stream_id: str) -> int:
+    # Per channel/DM event sequence, shared by all workers
+    counter = await db.counters.find_one_and_update(
+        {"_id": f"seq:{stream_id}"}, {"$inc": {"seq": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+async def current_seq(stream_id: str) -> int:
+    counter = await db.counters.find_one({"_id": f"seq:{stream_id}"})
+    return counter["seq"] if counter else 0
+
+async def fetch_by_ids(collection, ids, projection: Dict[str, int]) -> Dict[str, dict]:
+    # One $in round trip for a batch of ids, keyed by id for in-memory joins
+    ids = list({i for i in ids if i})
+    if not ids:
+        return {}
+    docs = await collection.find({"id": {"$in": ids}}, {**projection, "_id": 0, "id": 1}).to_list(len(ids))
+    return {doc.pop("id"): doc for doc in docs}
+
+async def populate_users(docs: List[dict], projection: Dict[str, int]):
+    users = await fetch_by_ids(db.users, [doc.get("user_id") for doc in docs], projection)
+    for doc in docs:
+        user = users.get(doc.get("user_id"))
+        if user:
+            doc["user"] = user
+
+def encode_cursor(msg: dict) -> str:
+    raw = json.dumps([msg["timestamp"].isoformat(), msg["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, msg_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(timestamp), msg_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def get_message_page(query: Dict[str, Any], before: Optional[str], after: Optional[str], limit: int):
+    # Keyset pagination on (timestamp, id); newest page first unless paging forward with `after`
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+    stream_id = query.get("channel_id") or query.get("dm_id")
+    cursor, op, direction = (after, "$gt", 1) if after else (before, "$lt", -1)
+    key = None
+    if cursor:
+        key = decode_cursor(cursor)
+        query = {**query, "$or": [
+            {"timestamp": {op: key[0]}},
+            {"timestamp": key[0], "id": {op: key[1]}}
+        ]}
+    
+    async def hot(n: int) -> List[dict]:
+        return await db.messages.find(query, {"_id": 0}).sort([("timestamp", direction), ("id", direction)]).limit(n).to_list(n)
+    
+    # Archived messages all sort before hot ones: older pages run on into the cold tier,
+    # forward pages start there
+    if direction == -1:
+        messages = await hot(limit + 1)
+        if len(messages) <= limit:
+            messages += await message_archive.read(stream_id, key, -1, limit + 1 - len(messages))
+    else:
+        messages = await message_archive.read(stream_id, key, 1, limit + 1)
+        if len(messages) <= limit:
+            messages += await hot(limit + 1 - len(messages))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = encode_cursor(messages[-1]) if has_more else None
+    if direction == -1:
+        messages.reverse()
+    return messages, next_cursor
+
+async def fetch_session_data(session_id: str) -> Optional[dict]:
+    # Exchange an OAuth session id for the user's session data, retrying transient failures
+    if session_id in session_data_cache:
+        return session_data_cache[session_id]
+    for attempt in range(SESSION_DATA_RETRIES + 1):
+        try:
+            response = await http_client.get(SESSION_DATA_URL, headers={"X-Session-ID": session_id})
+        except httpx.TransportError as e:
+            logger.warning(f"Session data request failed (attempt {attempt + 1}): {e}")
+        else:
+            if response.status_code == 200:
+                data = response.json()
+                session_data_cache[session_id] = data
+                return data
+            if response.status_code < 500:
+                return None
+            logger.warning(f"Session data request returned {response.status_code} (attempt {attempt + 1})")
+        if attempt < SESSION_DATA_RETRIES:
+            await asyncio.sleep(0.2 * 2 ** attempt)
+    raise HTTPException(status_code=502, detail="Session provider unavailable")
 
 # Auth endpoints
 @api_router.post("/auth/register")
@@ -227,12 +1790,13 @@ async def register(user_data: UserRegister):
         email=user_data.email,
         username=user_data.username,
         user_number=user_data.user_number,
-        password_hash=hash_password(user_data.password)
+        password_hash=await hash_password(user_data.password)
     )
     
     doc = user.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
+    doc['username_lower'] = user.username.lower()
     await db.users.insert_one(doc)
+    await stats_counters.incr(users=1)
     
     # Create JWT token
     token = create_jwt_token(user.id)
@@ -244,7 +1808,7 @@ async def register(user_data: UserRegister):
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin):
     user_doc = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user_doc or not verify_password(credentials.password, user_doc.get("password_hash", "")):
+    if not user_doc or not await verify_password(credentials.password, user_doc.get("password_hash", "")):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     user = User(**user_doc)
@@ -265,15 +1829,11 @@ async def create_session(session_id: str = Header(None, alias="X-Session-ID")):
         raise HTTPException(status_code=400, detail="Session ID required")
     
     # Get session data from Emergent Auth
-    response = requests.get(
-        "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-        headers={"X-Session-ID": session_id}
-    )
+    data = await fetch_session_data(session_id)
     
-    if response.status_code != 200:
+    if data is None:
         raise HTTPException(status_code=401, detail="Invalid session")
     
-    data = response.json()
     email = data.get("email")
     name = data.get("name")
     picture = data.get("picture")
@@ -293,8 +1853,9 @@ async def create_session(session_id: str = Header(None, alias="X-Session-ID")):
             google_id=google_id
         )
         doc = user.model_dump()
-        doc['created_at'] = doc['created_at'].isoformat()
+        doc['username_lower'] = (name or "").lower()
         await db.users.insert_one(doc)
+        await stats_counters.incr(users=1)
         user_id = user.id
     else:
         user_id = user_doc["id"]
@@ -306,9 +1867,8 @@ async def create_session(session_id: str = Header(None, alias="X-Session-ID")):
         expires_at=datetime.now(timezone.utc) + timedelta(days=7)
     )
     session_doc = session.model_dump()
-    session_doc['expires_at'] = session_doc['expires_at'].isoformat()
-    session_doc['created_at'] = session_doc['created_at'].isoformat()
-    await db.user_sessions.insert_one(session_doc)
+    # Duplicate exchanges of the same session id must not create a second row
+    await db.user_sessions.update_one({"session_token": session_token}, {"$setOnInsert": session_doc}, upsert=True)
     
     await log_activity(user_id, "google_login", {"email": email})
     
@@ -317,12 +1877,15 @@ async def create_session(session_id: str = Header(None, alias="X-Session-ID")):
 @api_router.get("/auth/me")
 async def get_me(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(authorization, session_token)
-    return {"id": user.id, "email": user.email, "username": user.username, "user_number": user.user_number, "avatar": user.avatar, "status": user.status, "is_admin": user.is_admin}
+    # Live presence, which every worker tracks from status events; the cached principal's status is stale
+    status = manager.user_status.get(user.id, "offline")
+    return {"id": user.id, "email": user.email, "username": user.username, "user_number": user.user_number, "avatar": user.avatar, "status": status, "is_admin": user.is_admin}
 
 @api_router.post("/auth/logout")
 async def logout(response: Response, session_token: Optional[str] = Cookie(None)):
     if session_token:
         await db.user_sessions.delete_one({"session_token": session_token})
+        await manager.session_ended(session_token)
     response.delete_cookie("session_token")
     return {"message": "Logged out"}
 
@@ -330,15 +1893,15 @@ async def logout(response: Response, session_token: Optional[str] = Cookie(None)
 @api_router.post("/servers")
 async def create_server(name: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(authorization, session_token)
+    check_rate_limit(user.id, "create_server")
     server = Server(name=name, owner_id=user.id)
     doc = server.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.servers.insert_one(doc)
+    await stats_counters.incr(servers=1)
     
     # Add creator as member
     member = ServerMember(server_id=server.id, user_id=user.id, role="owner")
     member_doc = member.model_dump()
-    member_doc['joined_at'] = member_doc['joined_at'].isoformat()
     await db.server_members.insert_one(member_doc)
     
     # Create default channels
@@ -346,13 +1909,15 @@ async def create_server(name: str, authorization: Optional[str] = Header(None),
     voice_channel = Channel(server_id=server.id, name="General Voice", type="voice")
     
     text_doc = text_channel.model_dump()
-    text_doc['created_at'] = text_doc['created_at'].isoformat()
     await db.channels.insert_one(text_doc)
     
     voice_doc = voice_channel.model_dump()
-    voice_doc['created_at'] = voice_doc['created_at'].isoformat()
     await db.channels.insert_one(voice_doc)
     
+    await manager.member_joined(user.id, server.id)
+    await manager.channel_created(text_channel.id, server.id)
+    await manager.channel_created(voice_channel.id, server.id)
+    
     await log_activity(user.id, "create_server", {"server_id": server.id, "server_name": name})
     
     return server.model_dump()
@@ -362,25 +1927,25 @@ async def get_servers(authorization: Optional[str] = Header(None), session_token
     user = await get_current_user(authorization, session_token)
     
     # Get servers where user is a member
-    memberships = await db.server_members.find({"user_id": user.id}, {"_id": 0}).to_list(1000)
-    server_ids = [m["server_id"] for m in memberships]
-    
-    servers = await db.servers.find({"id": {"$in": server_ids}}, {"_id": 0}).to_list(1000)
-    return servers
+    servers = await directory_cache.servers_for(user.id)
+    return ORJSONResponse(list(servers.values()))
 
 @api_router.get("/servers/{server_id}/channels")
 async def get_channels(server_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
-    await get_current_user(authorization, session_token)
-    channels = await db.channels.find({"server_id": server_id}, {"_id": 0}).to_list(1000)
-    return channels
+    user = await get_current_user(authorization, session_token)
+    await require_member(user, server_id)
+    channels = await directory_cache.channels_for(server_id)
+    return ORJSONResponse(channels)
 
 @api_router.post("/servers/{server_id}/channels")
 async def create_channel(server_id: str, name: str, channel_type: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(authorization, session_token)
+    check_rate_limit(user.id, "create_channel")
+    await require_member(user, server_id)
     channel = Channel(server_id=server_id, name=name, type=channel_type)
     doc = channel.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.channels.insert_one(doc)
+    await manager.channel_created(channel.id, server_id)
     
     await log_activity(user.id, "create_channel", {"server_id": server_id, "channel_id": channel.id, "channel_name": name})
     
@@ -388,33 +1953,48 @@ async def create_channel(server_id: str, name: str, channel_type: str, authoriza
 
 # Message endpoints
 @api_router.get("/channels/{channel_id}/messages")
-async def get_messages(channel_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
-    await get_current_user(authorization, session_token)
-    messages = await db.messages.find({"channel_id": channel_id}, {"_id": 0}).sort("timestamp", 1).to_list(1000)
+async def get_messages(channel_id: str, before: Optional[str] = None, after: Optional[str] = None, limit: int = MESSAGE_PAGE_DEFAULT, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(authorization, session_token)
+    await require_channel_member(user, channel_id)
+    messages, next_cursor = await get_message_page({"channel_id": channel_id}, before, after, limit)
     
     # Populate user info
-    for msg in messages:
-        user = await db.users.find_one({"id": msg["user_id"]}, {"_id": 0, "username": 1, "avatar": 1, "user_number": 1})
-        if user:
-            msg["user"] = user
+    await populate_users(messages, {"username": 1, "avatar": 1, "user_number": 1})
     
-    return messages
+    return ORJSONResponse({"messages": messages, "next_cursor": next_cursor})
 
-@api_router.post("/channels/{channel_id}/messages")
-async def send_message(channel_id: str, content: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
-    user = await get_current_user(authorization, session_token)
-    message = Message(channel_id=channel_id, user_id=user.id, content=content)
+async def check_attachments(attachments: Optional[List[str]]) -> List[str]:
+    attachments = list(dict.fromkeys(attachments or []))
+    if attachments:
+        found = await db.attachments.count_documents({"id": {"$in": attachments}})
+        if found != len(attachments):
+            raise HTTPException(status_code=400, detail="Unknown attachment")
+    return attachments
+
+async def post_channel_message(user: User, channel_id: str, content: str, attachments: Optional[List[str]] = None) -> Message:
+    check_rate_limit(user.id, "message")
+    server_id = await require_channel_member(user, channel_id)
+    message = Message(channel_id=channel_id, user_id=user.id, content=content, attachments=await check_attachments(attachments))
     doc = message.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
     await db.messages.insert_one(doc)
     
     # Broadcast to WebSocket
-    msg_data = message.model_dump()
+    msg_data = message.model_dump(mode="json")
     msg_data["user"] = {"username": user.username, "avatar": user.avatar, "user_number": user.user_number}
-    await manager.broadcast_to_channel({"type": "message", "data": msg_data}, channel_id)
+    seq = await next_seq(channel_id)
+    await manager.broadcast_to_channel({"type": "message", "seq": seq, "data": msg_data}, channel_id, seq)
+    stats_counters.record_message(server_id, message.timestamp)
+    await advance_read_marker(user.id, channel_id, seq)
+    await record_mentions(user.id, channel_id, content, seq)
     
     await log_activity(user.id, "send_message", {"channel_id": channel_id, "message_id": message.id})
     
+    return message
+
+@api_router.post("/channels/{channel_id}/messages")
+async def send_message(channel_id: str, content: str, attachments: Optional[List[str]] = Query(None), authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(authorization, session_token)
+    message = await post_channel_message(user, channel_id, content, attachments)
     return message.model_dump()
 
 # Direct messages
@@ -424,13 +2004,14 @@ async def get_dms(authorization: Optional[str] = Header(None), session_token: Op
     dms = await db.direct_messages.find({"participants": user.id}, {"_id": 0}).to_list(1000)
     
     # Populate other user info
+    other_user_ids = {dm["id"]: [p for p in dm["participants"] if p != user.id][0] for dm in dms}
+    other_users = await fetch_by_ids(db.users, other_user_ids.values(), {"username": 1, "avatar": 1, "status": 1})
     for dm in dms:
-        other_user_id = [p for p in dm["participants"] if p != user.id][0]
-        other_user = await db.users.find_one({"id": other_user_id}, {"_id": 0, "username": 1, "avatar": 1, "status": 1})
+        other_user = other_users.get(other_user_ids[dm["id"]])
         if other_user:
             dm["other_user"] = other_user
     
-    return dms
+    return ORJSONResponse(dms)
 
 @api_router.post("/dms")
 async def create_dm(other_user_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -446,62 +2027,334 @@ async def create_dm(other_user_id: str, authorization: Optional[str] = Header(No
     
     dm = DirectMessage(participants=[user.id, other_user_id])
     doc = dm.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.direct_messages.insert_one(doc)
+    await manager.dm_created(dm.id, dm.participants)
     
     return dm.model_dump()
 
+async def require_dm_participant(user: User, dm_id: str) -> List[str]:
+    participants = await directory_cache.dm_participants(dm_id)
+    if not participants or user.id not in participants:
+        raise HTTPException(status_code=404, detail="DM not found")
+    return participants
+
 @api_router.get("/dms/{dm_id}/messages")
-async def get_dm_messages(dm_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
-    await get_current_user(authorization, session_token)
-    messages = await db.messages.find({"dm_id": dm_id}, {"_id": 0}).sort("timestamp", 1).to_list(1000)
+async def get_dm_messages(dm_id: str, before: Optional[str] = None, after: Optional[str] = None, limit: int = MESSAGE_PAGE_DEFAULT, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(authorization, session_token)
+    await require_dm_participant(user, dm_id)
+    messages, next_cursor = await get_message_page({"dm_id": dm_id}, before, after, limit)
     
-    for msg in messages:
-        user = await db.users.find_one({"id": msg["user_id"]}, {"_id": 0, "username": 1, "avatar": 1})
-        if user:
-            msg["user"] = user
+    await populate_users(messages, {"username": 1, "avatar": 1})
     
-    return messages
+    return ORJSONResponse({"messages": messages, "next_cursor": next_cursor})
 
-@api_router.post("/dms/{dm_id}/messages")
-async def send_dm_message(dm_id: str, content: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
-    user = await get_current_user(authorization, session_token)
-    message = Message(dm_id=dm_id, user_id=user.id, content=content)
+async def post_dm_message(user: User, dm_id: str, content: str, attachments: Optional[List[str]] = None) -> Message:
+    check_rate_limit(user.id, "message")
+    participants = await require_dm_participant(user, dm_id)
+    message = Message(dm_id=dm_id, user_id=user.id, content=content, attachments=await check_attachments(attachments))
     doc = message.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
     await db.messages.insert_one(doc)
     
-    # Send to recipient via WebSocket
-    dm = await db.direct_messages.find_one({"id": dm_id}, {"_id": 0})
-    if dm:
-        recipient_id = [p for p in dm["participants"] if p != user.id][0]
-        msg_data = message.model_dump()
-        msg_data["user"] = {"username": user.username, "avatar": user.avatar}
-        await manager.send_personal_message({"type": "dm", "data": msg_data}, recipient_id)
+    # Send to both participants via WebSocket
+    msg_data = message.model_dump(mode="json")
+    msg_data["user"] = {"username": user.username, "avatar": user.avatar}
+    seq = await next_seq(dm_id)
+    await manager.broadcast_to_dm({"type": "dm", "seq": seq, "data": msg_data}, dm_id, participants, seq)
+    stats_counters.record_message(None, message.timestamp)
+    await advance_read_marker(user.id, dm_id, seq)
     
     await log_activity(user.id, "send_dm", {"dm_id": dm_id, "message_id": message.id})
     
+    return message
+
+@api_router.post("/dms/{dm_id}/messages")
+async def send_dm_message(dm_id: str, content: str, attachments: Optional[List[str]] = Query(None), authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(authorization, session_token)
+    message = await post_dm_message(user, dm_id, content, attachments)
     return message.model_dump()
 
+# Read markers and unread counts. Every channel/DM message already bumps the stream's seq
+# counter, so unread = seq - last_read_seq needs no per-member write when a message is sent;
+# the message frame carries the new seq for clients to update their counts. Only mentioned
+# users get a write (bounded by MAX_MENTIONS) and an "unread" frame.
+async def advance_read_marker(user_id: str, stream_id: str, seq: int):
+    # A user's own message marks everything before it as read
+    await db.read_states.update_one(
+        {"user_id": user_id, "stream_id": stream_id},
+        {"$max": {"last_read_seq": seq}, "$setOnInsert": {"mentions": 0}},
+        upsert=True
+    )
+
+async def record_mentions(author_id: str, channel_id: str, content: str, seq: int):
+    names = list(dict.fromkeys(name.lower() for name in MENTION_RE.findall(content)))[:MAX_MENTIONS]
+    if not names:
+        return
+    server_id = await directory_cache.channel_server(channel_id)
+    users = await db.users.find({"username_lower": {"$in": names}}, {"_id": 0, "id": 1}).to_list(len(names) * 10)
+    members = await db.server_members.find(
+        {"server_id": server_id, "user_id": {"$in": [u["id"] for u in users if u["id"] != author_id]}},
+        {"_id": 0, "user_id": 1}
+    ).to_list(None)
+    mentioned = [m["user_id"] for m in members]
+    if not mentioned:
+        return
+    await db.read_states.bulk_write([
+        UpdateOne({"user_id": uid, "stream_id": channel_id}, {"$inc": {"mentions": 1}, "$setOnInsert": {"last_read_seq": 0}}, upsert=True)
+        for uid in mentioned
+    ], ordered=False)
+    states = await db.read_states.find({"user_id": {"$in": mentioned}, "stream_id": channel_id}, {"_id": 0}).to_list(None)
+    for state in states:
+        await manager.send_personal_message(unread_frame(state, seq), state["user_id"])
+
+def unread_frame(state: dict, seq: int) -> dict:
+    return {
+        "type": "unread", "stream_id": state["stream_id"], "seq": seq,
+        "last_read_seq": state["last_read_seq"], "unread": max(seq - state["last_read_seq"], 0),
+        "mentions": state.get("mentions", 0)
+    }
+
+async def check_stream_access(user: User, stream_id: str):
+    server_id = await directory_cache.channel_server(stream_id)
+    if server_id is not None:
+        if await directory_cache.is_member(user.id, server_id):
+            return
+    elif user.id in (await directory_cache.dm_participants(stream_id) or ()):
+        return
+    raise HTTPException(status_code=404, detail="Channel or DM not found")
+
+async def mark_read(user: User, stream_id: str, seq: Optional[int] = None) -> dict:
+    # Clients coalesce markers; the limit keeps a misbehaving one from turning every
+    # message into a write per viewer
+    check_rate_limit(user.id, "read")
+    await check_stream_access(user, stream_id)
+    latest = await current_seq(stream_id)
+    seq = latest if seq is None else min(seq, latest)
+    state = await db.read_states.find_one_and_update(
+        {"user_id": user.id, "stream_id": stream_id},
+        {"$max": {"last_read_seq": seq}, "$set": {"mentions": 0}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+    frame = unread_frame(state, latest)
+    # Keeps the user's other sessions in sync
+    await manager.send_personal_message(frame, user.id)
+    return frame
+
+@api_router.post("/read/{stream_id}")
+async def mark_stream_read(stream_id: str, seq: Optional[int] = None, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(authorization, session_token)
+    frame = await mark_read(user, stream_id, seq)
+    return {k: v for k, v in frame.items() if k != "type"}
+
+@api_router.get("/unread")
+async def get_unread(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(authorization, session_token)
+    dms, states = await asyncio.gather(
+        db.direct_messages.find({"participants": user.id}, {"_id": 0, "id": 1}).to_list(None),
+        db.read_states.find({"user_id": user.id}, {"_id": 0, "stream_id": 1, "last_read_seq": 1, "mentions": 1}).to_list(None),
+    )
+    # Channels come from this one servers_for snapshot, so every server_id is in result["servers"]
+    server_ids = list(await directory_cache.servers_for(user.id))
+    channels = []
+    for server_id in server_ids:
+        channels += [c for c in await directory_cache.channels_for(server_id) if c["type"] == "text"]
+    stream_ids = [c["id"] for c in channels] + [dm["id"] for dm in dms]
+    counters = await db.counters.find({"_id": {"$in": [f"seq:{i}" for i in stream_ids]}}).to_list(None)
+    seqs = {c["_id"][4:]: c["seq"] for c in counters}
+    states = {state["stream_id"]: state for state in states}
+    
+    def counts(stream_id: str) -> dict:
+        state = states.get(stream_id, {})
+        seq, last_read = seqs.get(stream_id, 0), state.get("last_read_seq", 0)
+        return {"seq": seq, "last_read_seq": last_read, "unread": max(seq - last_read, 0), "mentions": state.get("mentions", 0)}
+    
+    result = {"servers": {server_id: {"unread": 0, "mentions": 0} for server_id in server_ids}, "channels": {}, "dms": {}}
+    for channel in channels:
+        entry = result["channels"][channel["id"]] = {"server_id": channel["server_id"], **counts(channel["id"])}
+        server = result["servers"][channel["server_id"]]
+        server["unread"] += entry["unread"]
+        server["mentions"] += entry["mentions"]
+    for dm in dms:
+        result["dms"][dm["id"]] = counts(dm["id"])
+    return result
+
+# Attachments
+def blob_path(sha256: str) -> Path:
+    return BLOB_DIR / sha256[:2] / sha256
+
+def parse_range(range_header: str, size: int):
+    # Single "bytes=start-end" / "bytes=start-" / "bytes=-suffix" range, None when unsatisfiable
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+def read_blob_range(path: Path, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def served_content_type(content_type: Optional[str]) -> str:
+    # The client's type without parameters, or octet-stream unless it is safe to render inline
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return media_type if media_type in INLINE_CONTENT_TYPES else "application/octet-stream"
+
+def attachment_headers(attachment: dict) -> Dict[str, str]:
+    disposition = "inline" if served_content_type(attachment.get("content_type")) in INLINE_CONTENT_TYPES else "attachment"
+    filename = attachment.get("filename")
+    if filename:
+        disposition += f"; filename*=utf-8''{quote(filename)}"
+    return {
+        "Content-Disposition": disposition,
+        "X-Content-Type-Options": "nosniff",
+        "Content-Security-Policy": "default-src 'none'; style-src 'unsafe-inline'; sandbox",
+    }
+
+@api_router.post("/attachments")
+async def upload_attachment(request: Request, x_filename: Optional[str] = Header(None), authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    # Raw request body, streamed to a temp file while hashing; the size limit is enforced per chunk
+    user = await get_current_user(authorization, session_token)
+    declared_size = request.headers.get("content-length")
+    if declared_size and declared_size.isdigit() and int(declared_size) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+    
+    tmp_dir = BLOB_DIR / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = tmp_dir / str(uuid.uuid4())
+    digest = hashlib.sha256()
+    size = 0
+    loop = asyncio.get_running_loop()
+    try:
+        with open(tmp_path, "wb") as f:
+            buffer = bytearray()
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                digest.update(chunk)
+                buffer += chunk
+                if len(buffer) >= UPLOAD_WRITE_SIZE:
+                    await loop.run_in_executor(None, f.write, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await loop.run_in_executor(None, f.write, bytes(buffer))
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Empty upload")
+        
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+        if path.exists():
+            tmp_path.unlink()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    
+    attachment = {
+        "id": sha256,
+        "size": size,
+        "content_type": served_content_type(request.headers.get("content-type")),
+        "filename": x_filename,
+        "uploaded_by": user.id,
+        "created_at": datetime.now(timezone.utc)
+    }
+    await db.attachments.update_one({"id": sha256}, {"$setOnInsert": attachment}, upsert=True)
+    await log_activity(user.id, "upload_attachment", {"attachment_id": sha256, "size": size})
+    
+    return {"id": sha256, "size": size, "url": f"/api/attachments/{sha256}"}
+
+@api_router.get("/attachments/{attachment_id}")
+async def download_attachment(attachment_id: str, range_header: Optional[str] = Header(None, alias="Range"), authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    await get_current_user(authorization, session_token)
+    if not re.fullmatch(r"[0-9a-f]{64}", attachment_id):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    attachment = await db.attachments.find_one({"id": attachment_id}, {"_id": 0})
+    path = blob_path(attachment_id)
+    if not attachment or not path.exists():
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    
+    size = path.stat().st_size
+    headers = {
+        "Accept-Ranges": "bytes", "ETag": f'"{attachment_id}"', "Cache-Control": "private, max-age=31536000, immutable",
+        **attachment_headers(attachment)
+    }
+    # Rows stored before the allow-list may carry any client-supplied type
+    media_type = served_content_type(attachment.get("content_type"))
+    if range_header:
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(read_blob_range(path, start, end), status_code=206, media_type=media_type, headers=headers)
+    
+    # FileResponse uses the server's zero-copy sendfile extension when available
+    return FileResponse(path, media_type=media_type, headers=headers)
+
 # User search
 @api_router.get("/users/search")
 async def search_users(query: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
-    await get_current_user(authorization, session_token)
+    user = await get_current_user(authorization, session_token)
+    check_rate_limit(user.id, "search")
+    # Anchored, case-sensitive prefixes so both branches are index range scans
+    conditions = [{"username_lower": {"$regex": "^" + re.escape(query.lower())}}]
+    if query.isdigit():
+        conditions.append({"user_number": {"$regex": "^" + query}})
     users = await db.users.find(
-        {"$or": [
-            {"username": {"$regex": query, "$options": "i"}},
-            {"user_number": {"$regex": query}}
-        ]},
+        {"$or": conditions},
         {"_id": 0, "id": 1, "username": 1, "avatar": 1, "user_number": 1, "status": 1}
     ).to_list(20)
-    return users
+    return ORJSONResponse(users)
+
+@api_router.get("/search/messages")
+async def search_messages(query: str, channel_id: Optional[str] = None, offset: int = 0, limit: int = 20, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(authorization, session_token)
+    check_rate_limit(user.id, "search")
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    offset = max(0, offset)
+    
+    # Only channels of servers the caller belongs to, plus the caller's DMs
+    channel_ids = [c["id"] for c in await directory_cache.user_channels(user.id)]
+    if channel_id is not None:
+        if channel_id not in channel_ids:
+            raise HTTPException(status_code=403, detail="Not a member of this channel")
+        scope = {"channel_id": channel_id}
+    else:
+        dms = await db.direct_messages.find({"participants": user.id}, {"_id": 0, "id": 1}).to_list(1000)
+        scope = {"$or": [{"channel_id": {"$in": channel_ids}}, {"dm_id": {"$in": [dm["id"] for dm in dms]}}]}
+    
+    messages = await db.messages.find(
+        {"$text": {"$search": query}, **scope},
+        {"_id": 0, "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"}), ("timestamp", DESCENDING)]).skip(offset).limit(limit + 1).to_list(limit + 1)
+    
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    await populate_users(messages, {"username": 1, "avatar": 1, "user_number": 1})
+    
+    return ORJSONResponse({"messages": messages, "next_offset": offset + limit if has_more else None})
 
 # Admin endpoints
 @api_router.get("/admin/users")
 async def admin_get_users(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     await get_admin_user(authorization, session_token)
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(10000)
-    return users
+    users = await db.users.find({}, {"_id": 0, "password_hash": 0, "username_lower": 0}).to_list(10000)
+    return ORJSONResponse(users)
 
 @api_router.get("/admin/messages")
 async def admin_get_all_messages(limit: int = 100, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -509,19 +2362,22 @@ async def admin_get_all_messages(limit: int = 100, authorization: Optional[str]
     messages = await db.messages.find({}, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(limit)
     
     # Populate user info
+    await populate_users(messages, {"username": 1, "email": 1, "user_number": 1})
+    
+    # Get channel or DM info
+    await populate_locations(messages)
+    
+    return ORJSONResponse(messages)
+
+async def populate_locations(messages: List[dict]):
+    channels = await fetch_by_ids(db.channels, [msg.get("channel_id") for msg in messages], {"name": 1, "server_id": 1})
+    servers = await fetch_by_ids(db.servers, [c["server_id"] for c in channels.values()], {"name": 1})
     for msg in messages:
-        user = await db.users.find_one({"id": msg["user_id"]}, {"_id": 0, "username": 1, "email": 1, "user_number": 1})
-        if user:
-            msg["user"] = user
-        
-        # Get channel or DM info
-        if msg.get("channel_id"):
-            channel = await db.channels.find_one({"id": msg["channel_id"]}, {"_id": 0, "name": 1, "server_id": 1})
-            if channel:
-                server = await db.servers.find_one({"id": channel["server_id"]}, {"_id": 0, "name": 1})
+        channel = channels.get(msg.get("channel_id"))
+        if channel:
+            server = servers.get(channel["server_id"])
+            if server:
                 msg["location"] = f"{server['name']} > #{channel['name']}"
-    
-    return messages
 
 @api_router.get("/admin/activity")
 async def admin_get_activity(limit: int = 100, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
@@ -529,77 +2385,327 @@ async def admin_get_activity(limit: int = 100, authorization: Optional[str] = He
     activities = await db.activity_logs.find({}, {"_id": 0}).sort("timestamp", -1).limit(limit).to_list(limit)
     
     # Populate user info
-    for activity in activities:
-        user = await db.users.find_one({"id": activity["user_id"]}, {"_id": 0, "username": 1, "email": 1, "user_number": 1})
-        if user:
-            activity["user"] = user
+    await populate_users(activities, {"username": 1, "email": 1, "user_number": 1})
     
-    return activities
+    return ORJSONResponse(activities)
+
+# Streaming exports: documents are read from a cursor EXPORT_BATCH_SIZE at a time, joined
+# per batch and written out as NDJSON or CSV, so memory does not grow with the collection
+EXPORTS = {
+    "users": {
+        "collection": "users", "time_field": "created_at", "sort": None,
+        "projection": {"_id": 0, "password_hash": 0, "username_lower": 0},
+        "columns": ["id", "email", "username", "user_number", "status", "is_admin", "google_id", "created_at"],
+    },
+    "messages": {
+        "collection": "messages", "time_field": "timestamp", "sort": "timestamp", "projection": {"_id": 0},
+        "columns": ["id", "timestamp", "user_id", "user.username", "user.email", "user.user_number",
+                    "channel_id", "dm_id", "location", "content", "attachments"],
+    },
+    "activity": {
+        "collection": "activity_logs", "time_field": "timestamp", "sort": "timestamp", "projection": {"_id": 0},
+        "columns": ["id", "timestamp", "user_id", "user.username", "user.email", "user.user_number", "action", "details"],
+    },
+}
+
+def csv_value(doc: dict, column: str):
+    value = doc
+    for key in column.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+def encode_export_rows(docs: List[dict], fmt: str, columns: List[str], header: bool) -> bytes:
+    if fmt == "ndjson":
+        return b"".join(orjson.dumps(doc) + b"\n" for doc in docs)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    writer.writerows([csv_value(doc, column) for column in columns] for doc in docs)
+    return buffer.getvalue().encode()
+
+async def export_rows(kind: str, query: dict, fmt: str):
+    spec = EXPORTS[kind]
+    cursor = db[spec["collection"]].find(query, spec["projection"]).batch_size(EXPORT_BATCH_SIZE)
+    if spec["sort"]:
+        # Walks the timestamp index; users have no such index and stream in natural order
+        cursor = cursor.sort(spec["sort"], 1)
+    header = True
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) < EXPORT_BATCH_SIZE:
+            continue
+        yield await export_batch(kind, batch, fmt, header)
+        header = False
+        batch = []
+    if batch or header:
+        yield await export_batch(kind, batch, fmt, header)
+
+async def export_batch(kind: str, docs: List[dict], fmt: str, header: bool) -> bytes:
+    if kind != "users":
+        await populate_users(docs, {"username": 1, "email": 1, "user_number": 1})
+    if kind == "messages":
+        await populate_locations(docs)
+    return encode_export_rows(docs, fmt, EXPORTS[kind]["columns"], header)
+
+@api_router.get("/admin/export/{kind}")
+async def admin_export(kind: str, format: str = "ndjson", since: Optional[datetime] = None, until: Optional[datetime] = None, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    admin = await get_admin_user(authorization, session_token)
+    if kind not in EXPORTS:
+        raise HTTPException(status_code=404, detail="Unknown export")
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Format must be ndjson or csv")
+    
+    time_range = {}
+    if since:
+        time_range["$gte"] = since
+    if until:
+        time_range["$lt"] = until
+    query = {EXPORTS[kind]["time_field"]: time_range} if time_range else {}
+    
+    await log_activity(admin.id, "admin_export", {"kind": kind, "format": format})
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    return StreamingResponse(
+        export_rows(kind, query, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{kind}.{format}"'}
+    )
+
+async def delete_server(server_id: str) -> str:
+    # Remove the server immediately, leave its channels, members and messages to a deletion job
+    result = await db.servers.delete_one({"id": server_id})
+    await stats_counters.incr(servers=-result.deleted_count)
+    await db.server_stats.delete_one({"_id": server_id})
+    channels = await db.channels.find({"server_id": server_id}, {"_id": 0, "id": 1}).to_list(10000)
+    await manager.server_removed(server_id)
+    return await deletion_jobs.enqueue("server", server_id, [
+        {"collection": "messages", "filter": {"channel_id": {"$in": [c["id"] for c in channels]}}},
+        {"collection": "read_states", "filter": {"stream_id": {"$in": [c["id"] for c in channels]}}},
+        {"collection": "message_segments", "filter": {"stream_id": {"$in": [c["id"] for c in channels]}}},
+        {"collection": "channels", "filter": {"server_id": server_id}},
+        {"collection": "server_members", "filter": {"server_id": server_id}},
+    ])
 
 @api_router.delete("/admin/users/{user_id}")
 async def admin_delete_user(user_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     admin = await get_admin_user(authorization, session_token)
-    await db.users.delete_one({"id": user_id})
-    await log_activity(admin.id, "admin_delete_user", {"deleted_user_id": user_id})
-    return {"message": "User deleted"}
+    result = await db.users.delete_one({"id": user_id})
+    await stats_counters.incr(users=-result.deleted_count)
+    dms = await db.direct_messages.find({"participants": user_id}, {"_id": 0, "id": 1}).to_list(10000)
+    dm_ids = [dm["id"] for dm in dms]
+    # DM rows go first so no new message can land in a DM whose messages the job is removing
+    await db.direct_messages.delete_many({"id": {"$in": dm_ids}})
+    await manager.evict_user(user_id, dm_ids)
+    
+    owned_servers = await db.servers.find({"owner_id": user_id}, {"_id": 0, "id": 1}).to_list(1000)
+    server_job_ids = [await delete_server(server["id"]) for server in owned_servers]
+    job_id = await deletion_jobs.enqueue("user", user_id, [
+        {"collection": "user_sessions", "filter": {"user_id": user_id}},
+        {"collection": "server_members", "filter": {"user_id": user_id}},
+        {"collection": "read_states", "filter": {"user_id": user_id}},
+        {"collection": "messages", "filter": {"dm_id": {"$in": dm_ids}}},
+        {"collection": "message_segments", "filter": {"stream_id": {"$in": dm_ids}}},
+        {"collection": "messages", "filter": {"user_id": user_id}},
+        {"collection": "message_segments", "filter": {}, "user_id": user_id},
+    ])
+    
+    await log_activity(admin.id, "admin_delete_user", {"deleted_user_id": user_id, "job_id": job_id})
+    return {"message": "User deleted", "job_id": job_id, "server_job_ids": server_job_ids}
 
 @api_router.delete("/admin/messages/{message_id}")
-async def admin_delete_message(message_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+async def admin_delete_message(message_id: str, stream_id: Optional[str] = None, timestamp: Optional[datetime] = None, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    # stream_id (channel/DM id) and timestamp locate the message if it has moved to the archive
     admin = await get_admin_user(authorization, session_token)
-    await db.messages.delete_one({"id": message_id})
+    message = await db.messages.find_one_and_delete({"id": message_id})
+    if not message and stream_id and timestamp:
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        message = await message_archive.remove(stream_id, timestamp, message_id)
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    server_id = await directory_cache.channel_server(message["channel_id"]) if message.get("channel_id") else None
+    stats_counters.record_message(server_id, message["timestamp"], -1)
     await log_activity(admin.id, "admin_delete_message", {"message_id": message_id})
     return {"message": "Message deleted"}
 
 @api_router.delete("/admin/servers/{server_id}")
 async def admin_delete_server(server_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     admin = await get_admin_user(authorization, session_token)
-    await db.servers.delete_one({"id": server_id})
-    await db.channels.delete_many({"server_id": server_id})
-    await db.server_members.delete_many({"server_id": server_id})
-    await log_activity(admin.id, "admin_delete_server", {"server_id": server_id})
-    return {"message": "Server deleted"}
+    job_id = await delete_server(server_id)
+    await log_activity(admin.id, "admin_delete_server", {"server_id": server_id, "job_id": job_id})
+    return {"message": "Server deleted", "job_id": job_id}
+
+def job_progress(job: dict) -> dict:
+    steps = job.pop("steps")
+    job["total_steps"] = len(steps)
+    job["current_collection"] = steps[job["step"]]["collection"] if job["step"] < len(steps) else None
+    return job
+
+@api_router.get("/admin/jobs")
+async def admin_get_jobs(limit: int = 50, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    await get_admin_user(authorization, session_token)
+    jobs = await db.deletion_jobs.find({}, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    return ORJSONResponse([job_progress(job) for job in jobs])
+
+@api_router.get("/admin/jobs/{job_id}")
+async def admin_get_job(job_id: str, authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
+    await get_admin_user(authorization, session_token)
+    job = await db.deletion_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return ORJSONResponse(job_progress(job))
 
 @api_router.get("/admin/stats")
 async def admin_get_stats(authorization: Optional[str] = Header(None), session_token: Optional[str] = Cookie(None)):
     await get_admin_user(authorization, session_token)
     
-    total_users = await db.users.count_documents({})
-    total_servers = await db.servers.count_documents({})
-    total_messages = await db.messages.count_documents({})
-    online_users = len([u for u in manager.user_status.values() if u == "online"])
+    stats = await stats_counters.snapshot()
+    totals = stats["totals"]
+    online_users = len(manager.user_status)
     
     return {
-        "total_users": total_users,
-        "total_servers": total_servers,
-        "total_messages": total_messages,
-        "online_users": online_users
+        "total_users": totals.get("users", 0),
+        "total_servers": totals.get("servers", 0),
+        "total_messages": totals.get("messages", 0),
+        "online_users": online_users,
+        "daily_messages": stats["daily_messages"],
+        "top_servers": stats["top_servers"],
+        "auth_cache": principal_cache.stats(),
+        "directory_cache": directory_cache.stats(),
+        "archive": message_archive.stats(),
+        "activity_log": activity_logger.stats()
     }
 
 # WebSocket endpoint
+sent_nonces: TTLCache = TTLCache(maxsize=100000, ttl=WS_NONCE_TTL)  # (user_id, nonce): message
+
+async def authenticate_websocket(websocket: WebSocket, user_id: str) -> User:
+    # Sockets authenticate with ?token= or the session cookie and may only connect as themselves
+    token = websocket.query_params.get("token")
+    user = await get_current_user(f"Bearer {token}" if token else None, websocket.cookies.get("session_token"))
+    if user.id != user_id:
+        raise HTTPException(status_code=403, detail="Token does not match user")
+    return user
+
+async def handle_message_frame(user: User, data: dict):
+    nonce = data.get("nonce")
+    content = data.get("content")
+    target_id = data.get("channel_id") if data["type"] == "message" else data.get("dm_id")
+    attachments = data.get("attachments")
+    if not content or not isinstance(content, str) or not target_id or not isinstance(target_id, str):
+        await manager.send_local({"type": "error", "nonce": nonce, "detail": "content and channel_id/dm_id are required"}, user.id)
+        return
+    if attachments is not None and not (isinstance(attachments, list) and all(isinstance(a, str) for a in attachments)):
+        await manager.send_local({"type": "error", "nonce": nonce, "detail": "attachments must be a list of ids"}, user.id)
+        return
+    
+    # A retried nonce gets the original ack instead of a second message
+    key = (user.id, nonce)
+    if nonce and key in sent_nonces:
+        await manager.send_local({"type": "ack", "nonce": nonce, "data": sent_nonces[key]}, user.id)
+        return
+    
+    try:
+        if data["type"] == "message":
+            message = await post_channel_message(user, target_id, content, attachments)
+        else:
+            message = await post_dm_message(user, target_id, content, attachments)
+    except HTTPException as e:
+        frame = {"type": "error", "nonce": nonce, "detail": e.detail}
+        if e.status_code == 429:
+            frame["retry_after"] = int(e.headers["Retry-After"])
+        await manager.send_local(frame, user.id)
+        return
+    payload = message.model_dump(mode="json")
+    if nonce:
+        sent_nonces[key] = payload
+    await manager.send_local({"type": "ack", "nonce": nonce, "data": payload}, user.id)
+
+async def handle_frame(user: User, data: dict):
+    frame_type = data.get("type")
+    WS_FRAMES.labels("in", frame_type if frame_type in WS_FRAME_TYPES else "other").inc()
+    
+    # Handle WebRTC signaling
+    if frame_type in ["offer", "answer", "ice-candidate"]:
+        target_user_id = data.get("target_user_id")
+        if isinstance(target_user_id, str):
+            await manager.send_personal_message(data, target_user_id)
+    
+    # Handle typing indicator, throttled and sent as typing_batch frames
+    elif frame_type == "typing":
+        channel_id = data.get("channel_id")
+        if isinstance(channel_id, str) and user.id in manager.channel_subscribers.get(channel_id, ()):
+            manager.typing.typing(user.id, channel_id)
+    
+    # Handle messages sent over the socket, acked with the client's nonce
+    elif frame_type in ["message", "dm"]:
+        await handle_message_frame(user, data)
+    
+    # Handle read markers: {"type": "read", "stream_id": channel_or_dm_id, "seq": optional}
+    elif frame_type == "read":
+        seq = data.get("seq")
+        if isinstance(data.get("stream_id"), str) and (seq is None or isinstance(seq, int)):
+            try:
+                await mark_read(user, data["stream_id"], seq)
+            except HTTPException as e:
+                frame = {"type": "error", "detail": e.detail}
+                if e.status_code == 429:
+                    frame["retry_after"] = int(e.headers["Retry-After"])
+                await manager.send_local(frame, user.id)
+    
+    # Handle reconnects: {"type": "resume", "streams": {channel_or_dm_id: last_seq}}
+    elif frame_type == "resume":
+        streams = data.get("streams")
+        if isinstance(streams, dict):
+            await manager.resume(user.id, streams)
+    
+    # Handle away/dnd/online status changes
+    elif frame_type == "set_status":
+        if data.get("status") in PRESENCE_STATUSES:
+            await manager.presence.publish(user.id, data["status"])
+
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+    try:
+        user = await authenticate_websocket(websocket, user_id)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    await manager.connect(websocket, user.id)
     try:
         while True:
-            data = await websocket.receive_json()
-            
-            # Handle WebRTC signaling
-            if data.get("type") in ["offer", "answer", "ice-candidate"]:
-                target_user_id = data.get("target_user_id")
-                if target_user_id:
-                    await manager.send_personal_message(data, target_user_id)
-            
-            # Handle typing indicator
-            elif data.get("type") == "typing":
-                channel_id = data.get("channel_id")
-                await manager.broadcast_to_channel({"type": "typing", "user_id": user_id, "channel_id": channel_id}, channel_id)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            # A bad frame gets an error frame back instead of ending the connection
+            data = None
+            try:
+                data = json.loads(message.get("text") or message.get("bytes") or "")
+                if not isinstance(data, dict):
+                    raise ValueError("frame is not a JSON object")
+                await handle_frame(user, data)
+            except Exception as e:
+                logger.warning(f"Rejected WebSocket frame from {user.id}: {e!r}")
+                nonce = data.get("nonce") if isinstance(data, dict) else None
+                await manager.send_local({"type": "error", "nonce": nonce, "detail": "Invalid frame"}, user.id)
     
     except WebSocketDisconnect:
-        await manager.disconnect(user_id)
+        pass
+    finally:
+        await manager.disconnect(user.id, websocket)
 
 # Include router
 app.include_router(api_router)
 
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -607,6 +2713,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -614,6 +2721,61 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            logger.error(f"Failed to create index {keys} on {collection}: {e}")
+    
+    # Backfill the lowercased username used by prefix search for users created before it existed
+    try:
+        await db.users.update_many({"username_lower": {"$exists": False}}, [{"$set": {"username_lower": {"$toLower": "$username"}}}])
+    except OperationFailure as e:
+        logger.error(f"Failed to backfill username_lower: {e}")
+
+@app.on_event("startup")
+async def migrate_datetimes():
+    if await db.migrations.find_one({"_id": "bson_datetimes"}):
+        return
+    for collection, field in DATETIME_FIELDS:
+        try:
+            result = await db[collection].update_many({field: {"$type": "string"}}, [{"$set": {field: {"$toDate": f"${field}"}}}])
+            if result.modified_count:
+                logger.info(f"Converted {result.modified_count} {collection}.{field} values to dates")
+        except OperationFailure as e:
+            logger.error(f"Failed to convert {collection}.{field} to dates: {e}")
+            return
+    await db.migrations.update_one({"_id": "bson_datetimes"}, {"$set": {"applied_at": datetime.now(timezone.utc)}}, upsert=True)
+
+@app.on_event("startup")
+async def start_activity_logger():
+    activity_logger.start()
+
+@app.on_event("startup")
+async def start_connection_manager():
+    await manager.start()
+
+@app.on_event("startup")
+async def start_stats_counters():
+    stats_counters.start()
+
+@app.on_event("startup")
+async def start_deletion_jobs():
+    deletion_jobs.start()
+
+@app.on_event("startup")
+async def start_message_archive():
+    message_archive.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await activity_logger.stop()
+    await manager.stop()
+    await stats_counters.stop()
+    await deletion_jobs.stop()
+    await message_archive.stop()
     client.close()
+    await http_client.aclose()
+    password_executor.shutdown(wait=False)
@@ -0,0 +1,631 @@
+# Load test / benchmark for the backend. Starts the app in-process with uvicorn (or targets
+# --url), seeds synthetic users, servers, channels and message history, then runs a mixed
+# workload of logins, history loads, unread lookups, REST and WebSocket sends while
+# --sockets clients stay connected and time how long fan-out takes to reach them:
+# ws_deliver per delivery, ws_fanout per message until its last recipient had it, and
+# a fanout summary of deliveries per message. With --servers 1 --channels 1 every
+# message goes to every socket.
+# With --archive-after-days the seeded history is moved into the cold tier before the
+# workload runs, and the report gains hot/cold tier sizes; history_deep pages from a
+# random point in the seeded history.
+# With --workers N the app runs as N separate uvicorn processes sharing MONGO_URL and the
+# --broker-url Redis broker. Sockets and requests are spread over the workers, deliveries
+# are split into ws_deliver_local/ws_deliver_cross by whether the message was sent through
+# the receiving socket's worker, and the run fails when nothing crossed workers. Compare
+# against a --workers 1 run without a broker to see the latency the broker adds.
+# Seeded messages are drawn from a Zipf-distributed vocabulary so the `search` operation
+# ($text on messages.content, mongod only) sees realistic term frequencies;
+# --total-messages spreads a corpus of that size over the channels instead of --messages.
+# With --login-burst N, N logins are fired at once a third of the way into the run; `me`
+# requests made while they are in flight are reported as me_during_burst, so the p99 of
+# /api/auth/me with and without the burst can be read side by side.
+# With --reconnect-storm every connected socket is closed at once after the workload and,
+# --storm-gap seconds later, all reconnect together. ws_reconnect times the reconnects,
+# presence_deliver times each presence_batch frame from the start of the reconnect, and
+# the report counts the presence frames/updates the storm caused. A gap inside
+# PRESENCE_DEBOUNCE should cause none.
+# --serialization skips the server and times rendering a page of --page-size populated
+# messages, as serialize_jsonable_encoder (jsonable_encoder + JSONResponse, the old path)
+# and serialize_orjson (ORJSONResponse, what the history endpoints return).
+# Prints per-operation throughput and p50/p95/p99 latency as JSON and, given --baseline,
+# exits non-zero when an operation regressed by more than --tolerance.
+#
+#   MONGO_URL=mongodb://localhost:27017 python benchmark.py --users 2000 --sockets 1000 --output run.json
+#   python benchmark.py --in-memory --duration 10                     # needs mongomock-motor
+#   python benchmark.py --baseline baseline.json --output run.json   # compare against a stored run
+#   python benchmark.py --archive-after-days 7 --baseline hot-only.json  # tiered vs hot-only history reads
+#   python benchmark.py --workers 1 --output single.json                # one worker process, in-memory broker
+#   python benchmark.py --workers 2 --broker-url redis://localhost:6379/0 --baseline single.json
+#   python benchmark.py --total-messages 1000000 --mix search=1 --sockets 0  # search over a 1M-message corpus
+#   python benchmark.py --sockets 5000 --users 5000 --reconnect-storm --storm-gap 6  # past the presence debounce
+#   python benchmark.py --serialization --page-size 1000                # response rendering only
+#   MONGO_URL=... python benchmark.py --users 10000 --sockets 10000 --servers 1 --channels 1 \
+#       --mix ws_send=1 --concurrency 1 --output fanout-10k.json   # fan-out to 10k sockets per message
+#   python benchmark.py --in-memory --users 5000 --sockets 5000 --servers 1 --channels 1 --mix ws_send=1 \
+#       --concurrency 1 --connect-timeout 5000 --baseline benchmarks/fanout-5k-in-memory.json
+#   python benchmark.py --login-burst 200 --mix me=5,history=1          # /api/auth/me during a burst of logins
+#
+# The --db-name database is dropped and reseeded on every run.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+OPERATIONS = ["login", "me", "history", "history_deep", "unread", "search", "rest_send", "ws_send"]
+BENCH_PASSWORD = "benchmark-password"
+VOCABULARY = [f"word{i}" for i in range(5000)]
+# Zipf weights: word i is 1/(i+1) as common as word0
+VOCABULARY_WEIGHTS = [1 / (i + 1) for i in range(len(VOCABULARY))]
+WORDS_PER_MESSAGE = 8
+SEED_BATCH = 10000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Seed synthetic data and benchmark the backend")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of MONGO_URL")
+    parser.add_argument("--db-name", default="miiwiichat_bench")
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run the app as this many uvicorn processes instead of in-process")
+    parser.add_argument("--broker-url", default=os.environ.get("WS_BROKER_URL", ""),
+                        help="WS_BROKER_URL for the worker processes, required with --workers > 1")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--servers", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=5, help="text channels per server")
+    parser.add_argument("--messages", type=int, default=200, help="history messages per channel")
+    parser.add_argument("--total-messages", type=int, default=0,
+                        help="history messages in total, spread over the channels (overrides --messages)")
+    parser.add_argument("--sockets", type=int, default=200, help="concurrently connected WebSocket clients")
+    parser.add_argument("--connect-timeout", type=float, default=60,
+                        help="WebSocket handshake timeout, long enough for a whole reconnect storm to queue")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent workload clients")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--archive-after-days", type=float, default=0,
+                        help="archive messages older than this before the workload (seeded history is 30 days old)")
+    parser.add_argument("--reconnect-storm", action="store_true",
+                        help="after the workload, drop every socket and reconnect them all at once")
+    parser.add_argument("--storm-gap", type=float, default=0,
+                        help="seconds between the drop and the reconnect of --reconnect-storm")
+    parser.add_argument("--login-burst", type=int, default=0,
+                        help="logins fired at once a third of the way into the run")
+    parser.add_argument("--mix", default="login=1,me=2,history=5,history_deep=2,unread=2,rest_send=2,ws_send=2",
+                        help="relative weights of the workload operations")
+    parser.add_argument("--serialization", action="store_true",
+                        help="only time rendering a page of messages with jsonable_encoder+json vs orjson")
+    parser.add_argument("--page-size", type=int, default=1000, help="messages per page for --serialization")
+    parser.add_argument("--rounds", type=int, default=50, help="renders per encoder for --serialization")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative p95 increase / throughput decrease before failing")
+    args = parser.parse_args()
+    args.mix = {name: float(weight) for name, weight in (item.split("=") for item in args.mix.split(","))}
+    unknown = set(args.mix) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+    if args.in_memory and args.mix.get("search"):
+        parser.error("search needs mongod: mongomock does not implement $text")
+    if args.total_messages:
+        args.messages = -(-args.total_messages // (args.servers * args.channels))
+    if args.login_burst and not args.mix.get("me"):
+        parser.error("--login-burst needs me in --mix to measure /api/auth/me during the burst")
+    if args.workers and (args.in_memory or args.url):
+        parser.error("--workers needs a shared MONGO_URL and cannot be combined with --in-memory or --url")
+    if args.workers > 1 and not args.broker_url:
+        parser.error("--workers > 1 needs --broker-url (or WS_BROKER_URL) so events reach every worker")
+    args.sockets = min(args.sockets, args.users)
+    return args
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.counters = {}
+        self.deliveries = {}  # message content: [sockets reached, latency of the last one]
+        self.storm_started = None
+
+    def add(self, name: str, seconds: float):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def error(self, name: str):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def delivered(self, message: str, latency: float):
+        entry = self.deliveries.setdefault(message, [0, 0.0])
+        entry[0] += 1
+        entry[1] = max(entry[1], latency)
+
+    def fanout(self):
+        # Adds a ws_fanout sample per message and summarizes how many sockets each reached
+        if not self.deliveries:
+            return None
+        for _, last in self.deliveries.values():
+            self.add("ws_fanout", last)
+        counts = sorted(count for count, _ in self.deliveries.values())
+        return {
+            "messages": len(counts),
+            "deliveries": sum(counts),
+            "deliveries_per_message": round(sum(counts) / len(counts), 1),
+            "min_deliveries": counts[0],
+            "max_deliveries": counts[-1],
+        }
+
+    def report(self, elapsed: float) -> dict:
+        results = {}
+        for name in sorted(set(self.samples) | set(self.errors)):
+            samples = sorted(self.samples.get(name, []))
+            results[name] = {
+                "count": len(samples),
+                "errors": self.errors.get(name, 0),
+                "throughput": round(len(samples) / elapsed, 2),
+                **{f"p{p}_ms": round(percentile(samples, p) * 1000, 3) for p in (50, 95, 99)},
+            }
+        return results
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+async def seed(app_module, args):
+    db = app_module.db
+    rng = random.Random(args.seed)
+    password_hash = await app_module.hash_password(BENCH_PASSWORD)
+    users, servers, channels, members = [], [], [], []
+    for i in range(args.users):
+        user = app_module.User(email=f"bench{i}@example.com", username=f"bench{i}", user_number=f"{10000000 + i}",
+                               password_hash=password_hash).model_dump()
+        user["username_lower"] = user["username"]
+        users.append(user)
+    for i in range(args.servers):
+        servers.append(app_module.Server(name=f"bench-server-{i}", owner_id=users[i % args.users]["id"]).model_dump())
+        for j in range(args.channels):
+            channels.append(app_module.Channel(server_id=servers[-1]["id"], name=f"channel-{j}", type="text").model_dump())
+    # Users are spread round-robin over the servers
+    for i, user in enumerate(users):
+        server = servers[i % args.servers]
+        role = "owner" if server["owner_id"] == user["id"] else "member"
+        members.append(app_module.ServerMember(server_id=server["id"], user_id=user["id"], role=role).model_dump())
+    await db.users.insert_many(users)
+    await db.servers.insert_many(servers)
+    await db.channels.insert_many(channels)
+    await db.server_members.insert_many(members)
+
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    for channel in channels:
+        server_index = next(i for i, s in enumerate(servers) if s["id"] == channel["server_id"])
+        authors = users[server_index::args.servers]
+        for batch_start in range(0, args.messages, SEED_BATCH):
+            history = [
+                app_module.Message(channel_id=channel["id"], user_id=rng.choice(authors)["id"],
+                                   content=f"history {n} " + " ".join(rng.choices(VOCABULARY, VOCABULARY_WEIGHTS, k=WORDS_PER_MESSAGE)),
+                                   timestamp=start + timedelta(seconds=n)).model_dump()
+                for n in range(batch_start, min(batch_start + SEED_BATCH, args.messages))
+            ]
+            await db.messages.insert_many(history)
+
+    channels_by_server = {}
+    for channel in channels:
+        channels_by_server.setdefault(channel["server_id"], []).append(channel["id"])
+    # Cursors into the seeded history for history_deep
+    cursors = [app_module.encode_cursor({"timestamp": start + timedelta(seconds=rng.randrange(max(args.messages, 1))), "id": ""})
+               for _ in range(20)]
+    return [
+        {"id": user["id"], "email": user["email"], "token": app_module.create_jwt_token(user["id"]),
+         "channels": channels_by_server[servers[i % args.servers]["id"]], "cursors": cursors}
+        for i, user in enumerate(users)
+    ]
+
+
+async def collection_bytes(db, name: str):
+    try:
+        return (await db.command("collStats", name))["size"]
+    except Exception:
+        return None
+
+
+async def archive(app_module, args) -> dict:
+    db = app_module.db
+    hot_before = await db.messages.count_documents({})
+    hot_bytes_before = await collection_bytes(db, "messages")
+    app_module.message_archive.after_days = args.archive_after_days
+    started = time.perf_counter()
+    archived = await app_module.message_archive.archive()
+    return {
+        "archived": archived,
+        "seconds": round(time.perf_counter() - started, 2),
+        "hot_messages_before": hot_before,
+        "hot_messages_after": await db.messages.count_documents({}),
+        "hot_bytes_before": hot_bytes_before,
+        "hot_bytes_after": await collection_bytes(db, "messages"),
+        "segments": await db.message_segments.count_documents({}),
+        "segment_bytes": await collection_bytes(db, "message_segments"),
+    }
+
+
+class SocketClient:
+    # One connected user; acks resolve pending nonces and every benchmark message
+    # that arrives is timed from the send timestamp embedded in its content
+    def __init__(self, user, recorder, worker: int = 0, workers: int = 1):
+        self.user = user
+        self.recorder = recorder
+        self.worker = worker
+        self.workers = workers
+        self.pending = {}
+        self.ws = None
+        self.task = None
+
+    async def connect(self, ws_url: str, name: str = "ws_connect", timeout: float = 60):
+        import websockets
+        started = time.perf_counter()
+        self.ws = await websockets.connect(f"{ws_url}/ws/{self.user['id']}?token={self.user['token']}", max_size=None,
+                                           open_timeout=timeout)
+        self.recorder.add(name, time.perf_counter() - started)
+        self.task = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for raw in self.ws:
+                frame = json.loads(raw)
+                if frame.get("type") in ("ack", "error") and frame.get("nonce") in self.pending:
+                    self.pending.pop(frame["nonce"]).set_result(frame)
+                elif frame.get("type") == "message":
+                    content = frame["data"].get("content", "")
+                    if content.startswith("bench "):
+                        _, sent_at, worker = content.split()
+                        latency = time.perf_counter() - float(sent_at)
+                        self.recorder.add("ws_deliver", latency)
+                        self.recorder.delivered(content, latency)
+                        if self.workers > 1:
+                            self.recorder.add("ws_deliver_local" if int(worker) == self.worker else "ws_deliver_cross", latency)
+                elif frame.get("type") == "presence_batch" and self.recorder.storm_started is not None:
+                    self.recorder.count("presence_frames")
+                    self.recorder.count("presence_updates", len(frame["updates"]))
+                    self.recorder.add("presence_deliver", time.perf_counter() - self.recorder.storm_started)
+        except Exception:
+            pass
+
+    async def send_message(self, channel_id: str, timeout: float = 10) -> dict:
+        nonce = uuid.uuid4().hex
+        future = self.pending[nonce] = asyncio.get_running_loop().create_future()
+        await self.ws.send(json.dumps({"type": "message", "channel_id": channel_id, "nonce": nonce,
+                                       "content": f"bench {time.perf_counter()} {self.worker}"}))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(nonce, None)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.task is not None:
+            await self.task
+        self.ws = self.task = None
+
+
+async def reconnect_storm(args, app_module, ws_urls, sockets, recorder) -> dict:
+    # Presence frames are counted from the drop until the debounced updates have flushed
+    recorder.storm_started = time.perf_counter()
+    await asyncio.gather(*(client.close() for client in sockets.values()), return_exceptions=True)
+    await asyncio.sleep(args.storm_gap)
+
+    async def reconnect(client):
+        try:
+            await client.connect(ws_urls[client.worker], "ws_reconnect", args.connect_timeout)
+        except Exception:
+            recorder.error("ws_reconnect")
+
+    recorder.storm_started = time.perf_counter()
+    await asyncio.gather(*(reconnect(client) for client in sockets.values()))
+    reconnect_seconds = time.perf_counter() - recorder.storm_started
+    await asyncio.sleep(app_module.PRESENCE_DEBOUNCE + 2 * app_module.PRESENCE_FLUSH_INTERVAL)
+    return {
+        "sockets": len(sockets),
+        "reconnected": sum(client.ws is not None for client in sockets.values()),
+        "gap_seconds": args.storm_gap,
+        "reconnect_seconds": round(reconnect_seconds, 2),
+        "presence_frames": recorder.counters.get("presence_frames", 0),
+        "presence_updates": recorder.counters.get("presence_updates", 0),
+    }
+
+
+async def run_operation(name, https, user, sockets, rng):
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    channel_id = rng.choice(user["channels"])
+    worker = rng.randrange(len(https))
+    http = https[worker]
+    if name == "login":
+        response = await http.post("/api/auth/login", json={"email": user["email"], "password": BENCH_PASSWORD})
+    elif name == "me":
+        response = await http.get("/api/auth/me", headers=headers)
+    elif name == "history":
+        response = await http.get(f"/api/channels/{channel_id}/messages", params={"limit": 50}, headers=headers)
+    elif name == "history_deep":
+        response = await http.get(f"/api/channels/{channel_id}/messages",
+                                  params={"limit": 50, "before": rng.choice(user["cursors"])}, headers=headers)
+    elif name == "unread":
+        response = await http.get("/api/unread", headers=headers)
+    elif name == "search":
+        query = rng.choices(VOCABULARY, VOCABULARY_WEIGHTS)[0]
+        response = await http.get("/api/search/messages", params={"query": query, "limit": 20}, headers=headers)
+    elif name == "rest_send":
+        response = await http.post(f"/api/channels/{channel_id}/messages",
+                                   params={"content": f"bench {time.perf_counter()} {worker}"}, headers=headers)
+    else:
+        client = sockets[user["id"]]
+        frame = await client.send_message(channel_id)
+        return frame["type"] == "ack"
+    return response.status_code == 200
+
+
+async def workload(args, https, users, sockets, recorder):
+    rng = random.Random(args.seed)
+    names = [name for name in args.mix if name != "ws_send" or sockets]
+    weights = [args.mix[name] for name in names]
+    socket_users = [user for user in users if user["id"] in sockets]
+    deadline = time.perf_counter() + args.duration
+    burst = {"active": False}
+
+    async def client():
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            user = rng.choice(socket_users if name == "ws_send" else users)
+            # Only requests that start and finish inside the burst count as during it
+            during_burst = burst["active"]
+            started = time.perf_counter()
+            try:
+                ok = await run_operation(name, https, user, sockets, rng)
+            except Exception:
+                ok = False
+            if name == "me" and during_burst and burst["active"]:
+                name = "me_during_burst"
+            if ok:
+                recorder.add(name, time.perf_counter() - started)
+            else:
+                recorder.error(name)
+
+    async def login_burst():
+        import httpx
+        # Own connection pools, so the burst cannot queue the workload's requests client-side
+        limits = httpx.Limits(max_connections=args.login_burst)
+        burst_https = [httpx.AsyncClient(base_url=str(http.base_url), limits=limits, timeout=120) for http in https]
+        await asyncio.sleep(args.duration / 3)
+        burst_users = random.Random(args.seed + 1).choices(users, k=args.login_burst)
+        burst["active"] = True
+        started = time.perf_counter()
+        results = await asyncio.gather(*(run_operation("login", burst_https, user, sockets, rng) for user in burst_users),
+                                       return_exceptions=True)
+        burst["active"] = False
+        for http in burst_https:
+            await http.aclose()
+        recorder.add("login_burst", time.perf_counter() - started)
+        for ok in results:
+            if ok is not True:
+                recorder.error("login_burst")
+
+    tasks = [client() for _ in range(args.concurrency)]
+    if args.login_burst:
+        tasks.append(login_burst())
+    await asyncio.gather(*tasks)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_workers(args, http_client) -> list:
+    # One uvicorn process per worker, all on the same database and broker
+    env = {**os.environ, "DB_NAME": args.db_name, "WS_BROKER_URL": args.broker_url}
+    workers = []
+    for _ in range(args.workers):
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "Server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=Path(__file__).parent, env=env
+        )
+        workers.append((process, f"http://127.0.0.1:{port}"))
+    for process, base_url in workers:
+        deadline = time.perf_counter() + 60
+        while True:
+            if process.poll() is not None:
+                stop_workers(workers)
+                raise RuntimeError(f"worker {base_url} exited with {process.returncode}")
+            try:
+                if (await http_client.get(f"{base_url}/metrics")).status_code == 200:
+                    break
+            except Exception:
+                pass
+            if time.perf_counter() > deadline:
+                stop_workers(workers)
+                raise RuntimeError(f"worker {base_url} did not start")
+            await asyncio.sleep(0.2)
+    return workers
+
+
+def stop_workers(workers):
+    for process, _ in workers:
+        process.terminate()
+    for process, _ in workers:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, base in baseline["results"].items():
+        current = report["results"].get(name)
+        if current is None:
+            continue
+        if base["p95_ms"] and current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']}ms -> {current['p95_ms']}ms")
+        if name != "ws_connect" and base["throughput"] and current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput']}/s -> {current['throughput']}/s")
+    return regressions
+
+
+def serialization(app_module, args) -> dict:
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse, ORJSONResponse
+
+    # A history page as the endpoints return it: messages with their author populated
+    author = {"id": str(uuid.uuid4()), "username": "bench", "avatar": None, "user_number": "10000000"}
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    messages = [
+        {**app_module.Message(channel_id=str(uuid.uuid4()), user_id=author["id"], content=f"history {n}",
+                              timestamp=start + timedelta(seconds=n)).model_dump(), "user": author}
+        for n in range(args.page_size)
+    ]
+    recorder = Recorder()
+    encoders = {
+        "serialize_jsonable_encoder": lambda: JSONResponse(jsonable_encoder(messages)).body,
+        "serialize_orjson": lambda: ORJSONResponse(messages).body,
+    }
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        for name, render in encoders.items():
+            render_started = time.perf_counter()
+            render()
+            recorder.add(name, time.perf_counter() - render_started)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "backend": "none",
+        "bytes": {name: len(render()) for name, render in encoders.items()},
+        "results": recorder.report(time.perf_counter() - started),
+    }
+
+
+async def main(args):
+    import httpx
+    import uvicorn
+
+    os.environ["DB_NAME"] = args.db_name
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    import Server as app_module
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if args.serialization:
+        return serialization(app_module, args)
+
+    if args.in_memory:
+        from mongomock_motor import AsyncMongoMockClient
+        app_module.db = AsyncMongoMockClient(tz_aware=True)[args.db_name]
+    else:
+        await app_module.client.drop_database(args.db_name)
+
+    print(f"seeding {args.users} users, {args.servers} servers, {args.servers * args.channels} channels, "
+          f"{args.servers * args.channels * args.messages} messages", file=sys.stderr)
+    seed_started = time.perf_counter()
+    users = await seed(app_module, args)
+    seed_seconds = time.perf_counter() - seed_started
+    tiering = None
+    if args.archive_after_days:
+        print(f"archiving messages older than {args.archive_after_days} days", file=sys.stderr)
+        tiering = await archive(app_module, args)
+
+    # Seeded before the app starts, so the bulk load does not go through its indexes one row at a time
+    server = None
+    workers = []
+    if args.url:
+        base_urls = [args.url.rstrip("/")]
+    elif args.workers:
+        async with httpx.AsyncClient(timeout=5) as http_client:
+            workers = await start_workers(args, http_client)
+        base_urls = [base_url for _, base_url in workers]
+    else:
+        port = free_port()
+        base_urls = [f"http://127.0.0.1:{port}"]
+        server = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning"))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+
+    recorder = Recorder()
+    ws_urls = [base_url.replace("http", "ws", 1) for base_url in base_urls]
+    sockets = {user["id"]: SocketClient(user, recorder, i % len(base_urls), len(base_urls))
+               for i, user in enumerate(users[:args.sockets])}
+    connect_limit = asyncio.Semaphore(100)
+
+    async def connect(client):
+        async with connect_limit:
+            try:
+                await client.connect(ws_urls[client.worker], timeout=args.connect_timeout)
+            except Exception:
+                recorder.error("ws_connect")
+
+    await asyncio.gather(*(connect(client) for client in sockets.values()))
+    sockets = {user_id: client for user_id, client in sockets.items() if client.ws is not None}
+    print(f"{len(sockets)} sockets connected, running for {args.duration}s", file=sys.stderr)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    https = [httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) for base_url in base_urls]
+    started = time.perf_counter()
+    await workload(args, https, users, sockets, recorder)
+    elapsed = time.perf_counter() - started
+    # Let in-flight fan-out reach the sockets before they close
+    await asyncio.sleep(1)
+    for http in https:
+        await http.aclose()
+    storm = None
+    if args.reconnect_storm:
+        print(f"dropping and reconnecting {len(sockets)} sockets", file=sys.stderr)
+        storm = await reconnect_storm(args, app_module, ws_urls, sockets, recorder)
+
+    await asyncio.gather(*(client.close() for client in sockets.values()), return_exceptions=True)
+    if server is not None:
+        server.should_exit = True
+        await server_task
+    stop_workers(workers)
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "backend": "in-memory" if args.in_memory else ("url" if args.url else "mongod"),
+        "workers": len(base_urls),
+        "seed_seconds": round(seed_seconds, 2),
+        "elapsed_seconds": round(elapsed, 2),
+        "sockets_connected": len(sockets),
+        "tiering": tiering,
+        "reconnect_storm": storm,
+        "fanout": recorder.fanout(),
+        "results": recorder.report(elapsed),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    failed = False
+    if args.workers > 1 and not report["results"].get("ws_deliver_cross", {}).get("count"):
+        print("FAILED no message was delivered across workers", file=sys.stderr)
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,38 @@
+# Explains every query shape in Server.QUERY_SHAPES and exits non-zero if any
+# of them is answered with a collection scan.
+#
+#   MONGO_URL=mongodb://localhost:27017 DB_NAME=miiwiichat_check python check_indexes.py
+import asyncio
+import sys
+
+from Server import db, create_indexes, QUERY_SHAPES
+
+
+def find_stages(plan):
+    stages = [plan.get("stage")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += find_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += find_stages(child)
+    return stages
+
+
+async def main():
+    await create_indexes()
+    failures = 0
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = find_stages(explain["queryPlanner"]["winningPlan"])
+        status = "COLLSCAN" if "COLLSCAN" in stages else "ok"
+        if status != "ok":
+            failures += 1
+        print(f"{status:8} {collection} {query} sort={sort} -> {' < '.join(s for s in stages if s)}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
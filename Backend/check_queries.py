@@ -0,0 +1,152 @@
+# Counts the database queries issued by the history and admin list endpoints for a page of
+# 1 and of --page-size rows, and exits non-zero when either costs more than MAX_QUERIES, as
+# any per-row user/channel/server lookup would. Before the batched hydration a 1000-message
+# channel page cost 1001 queries.
+#
+#   MONGO_URL=mongodb://localhost:27017 DB_NAME=miiwiichat_check python check_queries.py
+#   python check_queries.py --in-memory    # needs mongomock-motor
+#
+# The DB_NAME database is dropped and reseeded.
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+# Queries per request once the caller's session and directory entries are cached:
+# the page itself, the cold tier when the hot page runs out and one $in lookup per joined collection
+MAX_QUERIES = {
+    "channel_messages": 3,
+    "dm_messages": 3,
+    "dms": 2,
+    "admin_messages": 4,
+    "admin_activity": 2,
+}
+QUERY_METHODS = {
+    "find", "find_one", "find_one_and_update", "aggregate", "count_documents", "distinct",
+    "insert_one", "insert_many", "update_one", "update_many", "delete_one", "delete_many", "bulk_write",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check that history pages cost a bounded number of queries")
+    parser.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of MONGO_URL")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--authors", type=int, default=100, help="distinct message authors")
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "miiwiichat_check")
+os.environ["MESSAGE_PAGE_MAX"] = str(max(args.page_size, int(os.environ.get("MESSAGE_PAGE_MAX", "200"))))
+
+import Server  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+class CountingCollection:
+    def __init__(self, collection, counts):
+        self.collection = collection
+        self.counts = counts
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if name not in QUERY_METHODS:
+            return attr
+
+        def counted(*a, **kw):
+            self.counts.append((self.collection.name, name))
+            return attr(*a, **kw)
+        return counted
+
+
+class CountingDatabase:
+    def __init__(self, database):
+        self.database = database
+        self.counts = []
+
+    def __getitem__(self, name):
+        return CountingCollection(self.database[name], self.counts)
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+async def seed(db, authors: int, messages: int):
+    await db.client.drop_database(db.name)
+    now = datetime.now(timezone.utc)
+    users = [{"id": str(uuid.uuid4()), "email": f"user{i}@check.local", "username": f"user{i}",
+              "username_lower": f"user{i}", "user_number": f"{i:08d}", "status": "offline",
+              "is_admin": i == 0, "created_at": now} for i in range(authors)]
+    server = {"id": str(uuid.uuid4()), "name": "check", "owner_id": users[0]["id"], "created_at": now}
+    channel = {"id": str(uuid.uuid4()), "server_id": server["id"], "name": "general", "type": "text", "created_at": now}
+    dm = {"id": str(uuid.uuid4()), "participants": [users[0]["id"], users[1]["id"]], "created_at": now}
+    start = now - timedelta(hours=1)
+    await db.users.insert_many(users)
+    await db.servers.insert_one(server)
+    await db.channels.insert_one(channel)
+    await db.direct_messages.insert_one(dm)
+    await db.server_members.insert_many([
+        {"server_id": server["id"], "user_id": u["id"], "role": "member", "joined_at": now} for u in users
+    ])
+    await db.messages.insert_many([
+        {"id": str(uuid.uuid4()), "channel_id": channel["id"], "dm_id": None, "user_id": users[i % authors]["id"],
+         "content": f"message {i}", "attachments": [], "timestamp": start + timedelta(milliseconds=i)}
+        for i in range(messages)
+    ] + [
+        {"id": str(uuid.uuid4()), "channel_id": None, "dm_id": dm["id"], "user_id": dm["participants"][i % 2],
+         "content": f"dm {i}", "attachments": [], "timestamp": start + timedelta(milliseconds=i)}
+        for i in range(messages)
+    ])
+    await db.activity_logs.insert_many([
+        {"id": str(uuid.uuid4()), "user_id": users[i % authors]["id"], "action": "login", "details": {},
+         "timestamp": start + timedelta(milliseconds=i)}
+        for i in range(messages)
+    ])
+    return users[0], channel, dm
+
+
+def endpoints(channel: dict, dm: dict, limit: int):
+    return {
+        "channel_messages": f"/api/channels/{channel['id']}/messages?limit={limit}",
+        "dm_messages": f"/api/dms/{dm['id']}/messages?limit={limit}",
+        "dms": "/api/dms",
+        "admin_messages": f"/api/admin/messages?limit={limit}",
+        "admin_activity": f"/api/admin/activity?limit={limit}",
+    }
+
+
+def main():
+    if args.in_memory:
+        from mongomock_motor import AsyncMongoMockClient
+        Server.db = AsyncMongoMockClient(tz_aware=True)[os.environ["DB_NAME"]]
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    raw_db = Server.db
+    user, channel, dm = asyncio.run(seed(raw_db, args.authors, args.page_size))
+    counting_db = Server.db = CountingDatabase(raw_db)
+
+    client = TestClient(Server.app)
+    headers = {"Authorization": f"Bearer {Server.create_jwt_token(user['id'])}"}
+    failures = 0
+    for name, path in endpoints(channel, dm, 1).items():
+        # Warm the session and directory caches, then count one page of each size
+        assert client.get(path, headers=headers).status_code == 200
+        counts = []
+        for limit in (1, args.page_size):
+            del counting_db.counts[:]
+            response = client.get(endpoints(channel, dm, limit)[name], headers=headers)
+            assert response.status_code == 200, response.text
+            counts.append(len(counting_db.counts))
+        queries = ", ".join(f"{c}.{m}" for c, m in counting_db.counts)
+        ok = max(counts) <= MAX_QUERIES[name]
+        failures += not ok
+        print(f"{'ok' if ok else 'FAIL':8} {name}: {counts[0]} queries for 1 row, {counts[1]} for {args.page_size} "
+              f"(max {MAX_QUERIES[name]}) -> {queries}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
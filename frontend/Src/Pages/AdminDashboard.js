@@ -63,13 +63,14 @@ export default function AdminDashboard({ user }) {
     }
   };
 
-  const deleteMessage = async (messageId) => {
+  const deleteMessage = async (msg) => {
     if (!confirm('Are you sure you want to delete this message?')) return;
 
     try {
       const token = localStorage.getItem('token');
-      await axios.delete(`${API}/admin/messages/${messageId}`, {
-        headers: { Authorization: `Bearer ${token}` }
+      await axios.delete(`${API}/admin/messages/${msg.id}`, {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { stream_id: msg.channel_id || msg.dm_id, timestamp: msg.timestamp }
       });
       toast.success('Message deleted');
       fetchData();
@@ -303,7 +304,7 @@ export default function AdminDashboard({ user }) {
                           <p className="text-[#b5bac1] text-sm">{msg.content}</p>
                         </div>
                         <Button
-                          onClick={() => deleteMessage(msg.id)}
+                          onClick={() => deleteMessage(msg)}
                           variant="ghost"
                           size="sm"
                           className="text-[#f23f42] hover:text-white hover:bg-[#f23f42] ml-2"
@@ -14,6 +14,7 @@ import io from 'socket.io-client';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 const WS_URL = BACKEND_URL.replace('https://', 'wss://').replace('http://', 'ws://');
+const READ_FLUSH_MS = 1000;
 
 export default function MainApp({ user, setUser }) {
   const [servers, setServers] = useState([]);
@@ -32,20 +33,41 @@ export default function MainApp({ user, setUser }) {
   const [inCall, setInCall] = useState(false);
   const [isVideoCall, setIsVideoCall] = useState(false);
   const [sidebarOpen, setSidebarOpen] = useState(true);
+  const [unread, setUnread] = useState({});
+  const [olderCursor, setOlderCursor] = useState(null);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   
   const wsRef = useRef(null);
+  const lastSeqRef = useRef({});
+  const pendingReadsRef = useRef({});
+  const readTimerRef = useRef(null);
+  const closingRef = useRef(false);
+  const selectedChannelRef = useRef(null);
+  const selectedDMRef = useRef(null);
   const peerRef = useRef(null);
   const localVideoRef = useRef(null);
   const remoteVideoRef = useRef(null);
   const localStreamRef = useRef(null);
   const messagesEndRef = useRef(null);
+  const prependingRef = useRef(false);
 
   useEffect(() => {
     fetchServers();
     fetchDirectMessages();
+    fetchUnread();
     connectWebSocket();
+    // Send coalesced read markers right away when the user leaves the tab
+    const onHidden = () => {
+      if (document.visibilityState === 'hidden') flushReads();
+    };
+    window.addEventListener('blur', flushReads);
+    document.addEventListener('visibilitychange', onHidden);
 
     return () => {
+      closingRef.current = true;
+      window.removeEventListener('blur', flushReads);
+      document.removeEventListener('visibilitychange', onHidden);
+      flushReads();
       if (wsRef.current) {
         wsRef.current.close();
       }
@@ -61,9 +83,15 @@ export default function MainApp({ user, setUser }) {
     }
   }, [selectedServer]);
 
+  useEffect(() => {
+    selectedChannelRef.current = selectedChannel;
+    selectedDMRef.current = selectedDM;
+  }, [selectedChannel, selectedDM]);
+
   useEffect(() => {
     if (selectedChannel) {
       fetchMessages(selectedChannel.id);
+      markRead(selectedChannel.id);
       setSelectedDM(null);
     }
   }, [selectedChannel]);
@@ -71,31 +99,68 @@ export default function MainApp({ user, setUser }) {
   useEffect(() => {
     if (selectedDM) {
       fetchDMMessages(selectedDM.id);
+      markRead(selectedDM.id);
       setSelectedChannel(null);
     }
   }, [selectedDM]);
 
   useEffect(() => {
+    // Older pages are prepended above the reader, so only new messages scroll to the bottom
+    if (prependingRef.current) {
+      prependingRef.current = false;
+      return;
+    }
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [messages]);
 
   const connectWebSocket = () => {
-    const ws = new WebSocket(`${WS_URL}/ws/${user.id}`);
+    const token = localStorage.getItem('token');
+    const ws = new WebSocket(`${WS_URL}/ws/${user.id}${token ? `?token=${encodeURIComponent(token)}` : ''}`);
     
     ws.onopen = () => {
       console.log('WebSocket connected');
+      // Ask for whatever was missed while disconnected
+      if (Object.keys(lastSeqRef.current).length > 0) {
+        ws.send(JSON.stringify({ type: 'resume', streams: lastSeqRef.current }));
+      }
     };
 
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
       
+      const currentChannel = selectedChannelRef.current;
+      const currentDM = selectedDMRef.current;
+      
+      if ((data.type === 'message' || data.type === 'dm') && data.seq) {
+        const streamId = data.data.channel_id || data.data.dm_id;
+        lastSeqRef.current[streamId] = Math.max(lastSeqRef.current[streamId] || 0, data.seq);
+        if (streamId === currentChannel?.id || streamId === currentDM?.id) {
+          markRead(streamId, data.seq);
+        } else if (data.data.user_id !== user.id) {
+          // Unread counts follow the stream seq, no refetch needed
+          setUnread(prev => {
+            const entry = prev[streamId] || { unread: 0, mentions: 0 };
+            return { ...prev, [streamId]: { ...entry, unread: entry.unread + 1 } };
+          });
+        }
+      }
+      
       if (data.type === 'message') {
-        if (selectedChannel && data.data.channel_id === selectedChannel.id) {
-          setMessages(prev => [...prev, data.data]);
+        if (currentChannel && data.data.channel_id === currentChannel.id) {
+          setMessages(prev => prev.some(m => m.id === data.data.id) ? prev : [...prev, data.data]);
         }
       } else if (data.type === 'dm') {
-        if (selectedDM && data.data.dm_id === selectedDM.id) {
-          setMessages(prev => [...prev, data.data]);
+        if (currentDM && data.data.dm_id === currentDM.id) {
+          setMessages(prev => prev.some(m => m.id === data.data.id) ? prev : [...prev, data.data]);
+        }
+      } else if (data.type === 'unread') {
+        setUnread(prev => ({ ...prev, [data.stream_id]: { unread: data.unread, mentions: data.mentions } }));
+      } else if (data.type === 'resume_gap') {
+        // The server no longer buffers the gap, fall back to a history fetch
+        if (currentChannel && data.stream_id === currentChannel.id) {
+          fetchMessages(currentChannel.id);
+        } else if (currentDM && data.stream_id === currentDM.id) {
+          fetchDMMessages(currentDM.id);
         }
       } else if (data.type === 'offer' || data.type === 'answer' || data.type === 'ice-candidate') {
         handleWebRTCSignal(data);
@@ -106,6 +171,12 @@ export default function MainApp({ user, setUser }) {
       console.error('WebSocket error:', error);
     };
 
+    ws.onclose = () => {
+      if (!closingRef.current) {
+        setTimeout(connectWebSocket, 1000 + Math.random() * 2000);
+      }
+    };
+
     wsRef.current = ws;
   };
 
@@ -140,18 +211,99 @@ export default function MainApp({ user, setUser }) {
     }
   };
 
+  const fetchUnread = async () => {
+    try {
+      const token = localStorage.getItem('token');
+      const response = await axios.get(`${API}/unread`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      setUnread({ ...response.data.channels, ...response.data.dms });
+    } catch (error) {
+      console.error('Failed to fetch unread counts:', error);
+    }
+  };
+
+  // Badges clear immediately, but read markers are coalesced per stream and sent at most
+  // once per READ_FLUSH_MS (or on blur) instead of once per incoming message
+  const markRead = (streamId, seq) => {
+    setUnread(prev => ({ ...prev, [streamId]: { unread: 0, mentions: 0 } }));
+    const pending = pendingReadsRef.current;
+    // null means "up to the latest message"
+    pending[streamId] = seq === undefined || pending[streamId] === null
+      ? null
+      : Math.max(pending[streamId] || 0, seq);
+    if (!readTimerRef.current) {
+      readTimerRef.current = setTimeout(flushReads, READ_FLUSH_MS);
+    }
+  };
+
+  const flushReads = () => {
+    clearTimeout(readTimerRef.current);
+    readTimerRef.current = null;
+    const pending = pendingReadsRef.current;
+    pendingReadsRef.current = {};
+    Object.entries(pending).forEach(([streamId, seq]) => {
+      if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
+        wsRef.current.send(JSON.stringify({ type: 'read', stream_id: streamId, seq: seq ?? undefined }));
+      } else {
+        const token = localStorage.getItem('token');
+        axios.post(`${API}/read/${streamId}${seq ? `?seq=${seq}` : ''}`, {}, {
+          headers: { Authorization: `Bearer ${token}` }
+        }).catch(error => console.error('Failed to mark as read:', error));
+      }
+    });
+  };
+
+  const renderUnread = (streamId) => {
+    const entry = unread[streamId];
+    if (!entry || !entry.unread) return null;
+    return (
+      <span className={`ml-auto text-xs rounded-full px-1.5 text-white ${entry.mentions ? 'bg-[#f23f43]' : 'bg-[#4e5058]'}`}>
+        {entry.mentions || entry.unread}
+      </span>
+    );
+  };
+
   const fetchMessages = async (channelId) => {
     try {
       const token = localStorage.getItem('token');
       const response = await axios.get(`${API}/channels/${channelId}/messages`, {
         headers: { Authorization: `Bearer ${token}` }
       });
-      setMessages(response.data);
+      setMessages(response.data.messages);
+      setOlderCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Failed to fetch messages:', error);
     }
   };
 
+  const loadOlderMessages = async () => {
+    const channel = selectedChannelRef.current;
+    const dm = selectedDMRef.current;
+    if (!olderCursor || loadingOlder || (!channel && !dm)) return;
+    const path = channel ? `channels/${channel.id}` : `dms/${dm.id}`;
+    setLoadingOlder(true);
+    try {
+      const token = localStorage.getItem('token');
+      const response = await axios.get(`${API}/${path}/messages`, {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { before: olderCursor }
+      });
+      // Ignore the page if the user switched conversations while it loaded
+      if (selectedChannelRef.current !== channel || selectedDMRef.current !== dm) return;
+      prependingRef.current = true;
+      setMessages(prev => {
+        const seen = new Set(prev.map(m => m.id));
+        return [...response.data.messages.filter(m => !seen.has(m.id)), ...prev];
+      });
+      setOlderCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Failed to load older messages:', error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
   const fetchDirectMessages = async () => {
     try {
       const token = localStorage.getItem('token');
@@ -170,7 +322,8 @@ export default function MainApp({ user, setUser }) {
       const response = await axios.get(`${API}/dms/${dmId}/messages`, {
         headers: { Authorization: `Bearer ${token}` }
       });
-      setMessages(response.data);
+      setMessages(response.data.messages);
+      setOlderCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Failed to fetch DM messages:', error);
     }
@@ -556,6 +709,7 @@ export default function MainApp({ user, setUser }) {
                     >
                       <Hash className="w-4 h-4" />
                       <span className="text-sm">{channel.name}</span>
+                      {renderUnread(channel.id)}
                     </button>
                   ))}
 
@@ -664,6 +818,7 @@ export default function MainApp({ user, setUser }) {
                         <AvatarFallback>{dm.other_user?.username?.charAt(0)}</AvatarFallback>
                       </Avatar>
                       <span className="text-sm">{dm.other_user?.username}</span>
+                      {renderUnread(dm.id)}
                     </button>
                   ))}
                 </div>
@@ -723,6 +878,20 @@ export default function MainApp({ user, setUser }) {
         {/* Messages area */}
         <ScrollArea className="flex-1 px-4 py-4" data-testid="messages-area">
           <div className="space-y-4">
+            {olderCursor && (
+              <div className="flex justify-center">
+                <Button
+                  variant="ghost"
+                  size="sm"
+                  onClick={loadOlderMessages}
+                  disabled={loadingOlder}
+                  className="text-[#949ba4] hover:text-white"
+                  data-testid="load-older-button"
+                >
+                  {loadingOlder ? 'Loading...' : 'Load older messages'}
+                </Button>
+              </div>
+            )}
             {messages.map((msg) => (
               <div key={msg.id} className="flex gap-3" data-testid={`message-${msg.id}`}>
                 <Avatar className="w-10 h-10">